@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Describes the bones connecting the joints tracked by the Kinect, and
+measures the angle at each joint and the length of each bone from a frame of
+joint positions in a single vectorized pass.
+
+Each bone is named after the joint it ends at: the 'elbowleft' bone runs from
+'shoulderleft' to 'elbowleft'. Angles are measured at every joint with both
+a parent and exactly one child: the angle at 'elbowleft' is the angle between
+the upper and lower arm, so a straight arm is 180 degrees.
+"""
+
+from __future__ import print_function, division
+
+import numpy
+
+# The parent of every joint, starting from 'hipcenter' at the root.
+PARENTS = {
+    'spine': 'hipcenter',
+    'shouldercenter': 'spine',
+    'head': 'shouldercenter',
+    'shoulderleft': 'shouldercenter',
+    'elbowleft': 'shoulderleft',
+    'wristleft': 'elbowleft',
+    'handleft': 'wristleft',
+    'shoulderright': 'shouldercenter',
+    'elbowright': 'shoulderright',
+    'wristright': 'elbowright',
+    'handright': 'wristright',
+    'hipleft': 'hipcenter',
+    'kneeleft': 'hipleft',
+    'ankleleft': 'kneeleft',
+    'footleft': 'ankleleft',
+    'hipright': 'hipcenter',
+    'kneeright': 'hipright',
+    'ankleright': 'kneeright',
+    'footright': 'ankleright'
+}
+
+JOINT_NAMES = sorted(set(PARENTS) | set(PARENTS.values()))
+INDEX = dict((name, index) for index, name in enumerate(JOINT_NAMES))
+
+CHILDREN = dict((name, []) for name in JOINT_NAMES)
+for _child, _parent in PARENTS.items():
+    CHILDREN[_parent].append(_child)
+
+BONE_NAMES = sorted(PARENTS)
+ANGLE_NAMES = sorted(
+    name for name in PARENTS if len(CHILDREN[name]) == 1)
+
+_BONE_ENDS = numpy.array([INDEX[name] for name in BONE_NAMES])
+_BONE_STARTS = numpy.array([INDEX[PARENTS[name]] for name in BONE_NAMES])
+_ANGLE_VERTICES = numpy.array([INDEX[name] for name in ANGLE_NAMES])
+_ANGLE_PARENTS = numpy.array([INDEX[PARENTS[name]] for name in ANGLE_NAMES])
+_ANGLE_CHILDREN = numpy.array([INDEX[CHILDREN[name][0]] for name in ANGLE_NAMES])
+
+
+def empty_angles():
+    return dict((name, 0) for name in ANGLE_NAMES)
+
+
+def empty_lengths():
+    return dict((name, 0) for name in BONE_NAMES)
+
+
+def measure(positions):
+    '''Accepts an array of joint positions in meters, with one row of x, y,
+    and z per joint in JOINT_NAMES order. Returns a dictionary of joint
+    angles in degrees, and a dictionary of bone lengths in millimeters.'''
+    lengths = positions[_BONE_ENDS] - positions[_BONE_STARTS]
+    lengths = numpy.sqrt(numpy.einsum('ij,ij->i', lengths, lengths)) * 1000
+
+    towards_parent = positions[_ANGLE_PARENTS] - positions[_ANGLE_VERTICES]
+    towards_child = positions[_ANGLE_CHILDREN] - positions[_ANGLE_VERTICES]
+    dot = numpy.einsum('ij,ij->i', towards_parent, towards_child)
+    norms = (numpy.sqrt(numpy.einsum('ij,ij->i', towards_parent, towards_parent)) *
+             numpy.sqrt(numpy.einsum('ij,ij->i', towards_child, towards_child)))
+    cosines = numpy.divide(dot, norms, out=numpy.ones_like(dot), where=norms > 0)
+    angles = numpy.degrees(numpy.arccos(numpy.clip(cosines, -1, 1)))
+    angles[norms == 0] = 0
+
+    return (dict(zip(ANGLE_NAMES, angles.tolist())),
+            dict(zip(BONE_NAMES, lengths.tolist())))
@@ -1,2 +1,184 @@
 #!/usr/bin/env python
+"""
+Provides a live operations dashboard for the Kinect server, served from
+`localhost:5000/dashboard`. Once a second, a sampler thread records the sensor
+frame rate, capture-callback timing, per-route request rates and latencies,
+streaming clients, cache hit ratio, and tracked players into a fixed-size
+history. Each sample is serialized once and pushed to every open dashboard
+using server-sent events, so watching the dashboard does not itself add load.
+"""
 
+from __future__ import print_function, division
+
+from collections import deque
+import json
+import threading
+import time
+
+from flask import Response, g, request
+import gevent
+
+# Number of samples kept in memory, and the number of seconds between them.
+HISTORY = 300
+SAMPLE_INTERVAL = 1.0
+
+# How often each open dashboard checks for a new sample to push.
+PUSH_INTERVAL = SAMPLE_INTERVAL / 4
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, percent):
+    '''Returns the given percentile of an already-sorted list, using the
+    nearest-rank method.'''
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize_latencies(latencies, elapsed):
+    '''Returns the request rate and latency percentiles (in milliseconds)
+    for a list of request durations (in seconds).'''
+    latencies = sorted(latencies)
+    summary = {'rate': len(latencies) / elapsed}
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary['p{0}'.format(percent)] = None if value is None else value * 1000
+    return summary
+
+
+class Dashboard(object):
+    '''Collects server metrics into a fixed-size time series, and pushes
+    new samples to connected dashboards. To start sampling, call the `start`
+    method; to attach the dashboard routes and request timing to a Flask
+    app, call the `install` method.'''
+    def __init__(self, kinect_data, history=HISTORY):
+        self.kinect_data = kinect_data
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=history)
+        self.latest_event = None
+        self.sequence = 0
+
+        self.latencies = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.streaming_clients = 0
+
+        self.thread = threading.Thread(target=self._run, name='Dashboard')
+        self.thread.daemon = True
+
+    def start(self):
+        '''Starts the sampler thread.'''
+        self.thread.start()
+
+    def record_request(self, route, duration):
+        '''Records that a request to `route` took `duration` seconds.'''
+        with self.lock:
+            self.latencies.setdefault(route, []).append(duration)
+
+    def record_cache(self, hit):
+        '''Records a response cache lookup for the cache hit ratio.'''
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def add_streaming_client(self, delta):
+        '''Adjusts the number of clients with an open streaming response.'''
+        with self.lock:
+            self.streaming_clients += delta
+
+    def _run(self):
+        stats = self.kinect_data.stats
+        last_time = time.time()
+        last_frames = stats.frame_count
+        last_callback_time = stats.callback_time
+        # Waits on an event rather than sleeping, so the profiler can tell
+        # that the thread is idle.
+        idle = threading.Event()
+        while True:
+            idle.wait(SAMPLE_INTERVAL)
+            self.kinect_data.refresh()
+            now = time.time()
+            frames = stats.frame_count
+            callback_time = stats.callback_time
+            self._take_sample(
+                now,
+                now - last_time,
+                frames - last_frames,
+                callback_time - last_callback_time)
+            last_time = now
+            last_frames = frames
+            last_callback_time = callback_time
+
+    def _take_sample(self, now, elapsed, frames, callback_time):
+        with self.lock:
+            latencies = self.latencies
+            hits, misses = self.cache_hits, self.cache_misses
+            streaming_clients = self.streaming_clients
+            self.latencies = {}
+            self.cache_hits = self.cache_misses = 0
+
+        everything = [value for values in latencies.values() for value in values]
+        sample = {
+            'time': now,
+            'fps': frames / elapsed,
+            'callback_ms': callback_time / frames * 1000 if frames else None,
+            'requests': summarize_latencies(everything, elapsed),
+            'routes': dict(
+                (route, summarize_latencies(values, elapsed))
+                for route, values in latencies.items()),
+            'streaming_clients': streaming_clients,
+            'cache_hit_ratio': hits / (hits + misses) if hits + misses else None,
+            'tracked_players': len(self.kinect_data.get_tracked_players()),
+            'status': self.kinect_data.health()['status']
+        }
+        event = 'data: {0}\n\n'.format(json.dumps(sample))
+        with self.lock:
+            self.samples.append(sample)
+            self.latest_event = event
+            self.sequence += 1
+
+    def _history_event(self):
+        with self.lock:
+            return 'event: history\ndata: {0}\n\n'.format(
+                json.dumps(list(self.samples))), self.sequence
+
+    def stream(self):
+        '''Yields server-sent events: the full history, then each new
+        sample as it is taken.'''
+        self.add_streaming_client(1)
+        try:
+            event, sequence = self._history_event()
+            yield event
+            while True:
+                gevent.sleep(PUSH_INTERVAL)
+                if self.sequence != sequence:
+                    with self.lock:
+                        event, sequence = self.latest_event, self.sequence
+                    yield event
+        finally:
+            self.add_streaming_client(-1)
+
+    def install(self, app):
+        '''Adds the dashboard routes to `app`, and times every request.'''
+        @app.before_request
+        def start_request_timer():
+            g.request_start = time.time()
+
+        @app.after_request
+        def record_request_time(response):
+            rule = request.url_rule
+            route = rule.rule if rule is not None else 'unmatched'
+            self.record_request(route, time.time() - g.request_start)
+            return response
+
+        @app.route("/dashboard")
+        def dashboard():
+            return app.send_static_file("dashboard.html")
+
+        @app.route("/dashboard/stream")
+        def dashboard_stream():
+            return Response(self.stream(), mimetype='text/event-stream')
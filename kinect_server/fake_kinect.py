@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+"""
+Provides a fake stand-in for `pykinect.nui.Runtime` which produces synthetic
+skeleton frames, and which can be told to fail in the same ways a real Kinect
+does (refusing to open, or silently going quiet mid-lesson). Used to exercise
+the supervisor in `kinect.KinectData` without any hardware attached.
+
+Also provides stand-ins for the parts of `pykinect.nui` used by the server,
+which `kinect` falls back to when pykinect isn't installed (for example,
+when load testing on Linux).
+"""
+
+from __future__ import print_function, division
+
+import math
+import threading
+import time
+
+FRAME_RATE = 30
+MAX_SKELETONS = 6
+
+# The nominal focal length of the Kinect's depth camera at 320x240, used to
+# project skeleton positions onto the depth image.
+DEPTH_FOCAL_LENGTH = 285.63
+
+# Rough positions of each joint, in meters, of a person standing at the
+# origin facing the Kinect.
+STANDING_POSE = {
+    'head': (0.0, 0.65, 0.0),
+    'shouldercenter': (0.0, 0.45, 0.0),
+    'shoulderleft': (-0.18, 0.42, 0.0),
+    'shoulderright': (0.18, 0.42, 0.0),
+    'elbowleft': (-0.28, 0.18, 0.0),
+    'elbowright': (0.28, 0.18, 0.0),
+    'wristleft': (-0.32, -0.05, 0.0),
+    'wristright': (0.32, -0.05, 0.0),
+    'handleft': (-0.33, -0.12, 0.0),
+    'handright': (0.33, -0.12, 0.0),
+    'spine': (0.0, 0.05, 0.0),
+    'hipcenter': (0.0, 0.0, 0.0),
+    'hipleft': (-0.1, -0.05, 0.0),
+    'hipright': (0.1, -0.05, 0.0),
+    'kneeleft': (-0.11, -0.5, 0.0),
+    'kneeright': (0.11, -0.5, 0.0),
+    'ankleleft': (-0.11, -0.92, 0.0),
+    'ankleright': (0.11, -0.92, 0.0),
+    'footleft': (-0.12, -0.97, -0.08),
+    'footright': (0.12, -0.97, -0.08)
+}
+
+
+class JointId(object):
+    '''Mimics `pykinect.nui.JointId`.'''
+    HipCenter = 0
+    Spine = 1
+    ShoulderCenter = 2
+    Head = 3
+    ShoulderLeft = 4
+    ElbowLeft = 5
+    WristLeft = 6
+    HandLeft = 7
+    ShoulderRight = 8
+    ElbowRight = 9
+    WristRight = 10
+    HandRight = 11
+    HipLeft = 12
+    KneeLeft = 13
+    AnkleLeft = 14
+    FootLeft = 15
+    HipRight = 16
+    KneeRight = 17
+    AnkleRight = 18
+    FootRight = 19
+
+
+class _SkeletonTrackingState(object):
+    NOT_TRACKED = 0
+    POSITION_ONLY = 1
+    TRACKED = 2
+
+
+class _SkeletonEngineFunctions(object):
+    @staticmethod
+    def skeleton_to_depth_image(pos, width=1, height=1):
+        '''Mimics `nui.SkeletonEngine.skeleton_to_depth_image`.'''
+        if pos.z <= 0:
+            return 0.0, 0.0
+        x = 0.5 + pos.x * (DEPTH_FOCAL_LENGTH / pos.z) / 320.0
+        y = 0.5 - pos.y * (DEPTH_FOCAL_LENGTH / pos.z) / 240.0
+        return x * width, y * height
+
+
+class _Constants(object):
+    Video = 0
+    Depth = 1
+    Resolution320x240 = 1
+    Resolution640x480 = 2
+    Color = 0
+
+
+def _missing_runtime(*args):
+    raise IOError(
+        'pykinect is not installed; pass a fake_kinect.FakeKinect as the '
+        'runtime factory to use synthetic frames instead')
+
+
+class nui(object):
+    '''Mimics the parts of `pykinect.nui` used by the server.'''
+    SkeletonTrackingState = _SkeletonTrackingState
+    SkeletonEngine = _SkeletonEngineFunctions
+    ImageStreamType = _Constants
+    ImageResolution = _Constants
+    ImageType = _Constants
+    Runtime = staticmethod(_missing_runtime)
+
+
+class Vector(object):
+    '''Mimics the `Vector` struct pykinect uses for joint positions.'''
+    def __init__(self, x, y, z, w=1.0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.w = w
+
+
+class FakeSkeleton(object):
+    def __init__(self, tracking_state, positions):
+        self.eTrackingState = tracking_state
+        self.SkeletonPositions = positions
+
+
+class FakeFrame(object):
+    def __init__(self, skeletons):
+        self.SkeletonData = skeletons
+
+
+class _Event(object):
+    '''Mimics the pykinect event objects, which handlers are attached to
+    using `+=`.'''
+    def __init__(self):
+        self.handlers = []
+
+    def __iadd__(self, handler):
+        self.handlers.append(handler)
+        return self
+
+    def fire(self, *args):
+        for handler in self.handlers:
+            handler(*args)
+
+
+class _Stream(object):
+    def open(self, *args):
+        pass
+
+
+class _SkeletonEngine(object):
+    def __init__(self):
+        self.enabled = False
+
+
+def make_skeleton_positions(t, offset_x=0.0, depth=2.0):
+    '''Returns the joint positions of a synthetic person, `depth` meters
+    away from the Kinect, who sways from side to side and waves their arms
+    up and down. `t` is the time in seconds.'''
+    import kinect
+
+    sway = 0.3 * math.sin(t * 0.5) + offset_x
+    wave = 0.5 + 0.5 * math.sin(t * 2.0)
+    positions = {}
+    for name, joint_id in kinect.JOINTS.items():
+        x, y, z = STANDING_POSE[name]
+        if name in ('elbowleft', 'elbowright'):
+            y += 0.2 * wave
+        elif name in ('wristleft', 'wristright', 'handleft', 'handright'):
+            y += 0.6 * wave
+            x *= 1 + 0.3 * wave
+        positions[joint_id] = Vector(x + sway, y, depth + z)
+    return positions
+
+
+class FakeRuntime(object):
+    '''Mimics `nui.Runtime`. Once the skeleton engine is enabled, fires
+    the `skeleton_frame_ready` event FRAME_RATE times a second with one or
+    more synthetic players in view.'''
+    def __init__(self, kinect, num_players=1):
+        if kinect.is_unplugged():
+            raise IOError('Fake Kinect is unplugged')
+        self.kinect = kinect
+        self.num_players = num_players
+        self.skeleton_engine = _SkeletonEngine()
+        self.skeleton_frame_ready = _Event()
+        self.video_stream = _Stream()
+        self.depth_stream = _Stream()
+        self.closed = threading.Event()
+        self.dead = False
+
+        self.thread = threading.Thread(
+            target=self._pump, name='FakeRuntime')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _pump(self):
+        import kinect
+
+        tracked = kinect.nui.SkeletonTrackingState.TRACKED
+        not_tracked = kinect.nui.SkeletonTrackingState.NOT_TRACKED
+        start = time.time()
+        while not self.closed.wait(1 / FRAME_RATE):
+            if self.kinect.consume_stall() or self.kinect.is_unplugged():
+                # A real Kinect which glitches stays silent until the
+                # runtime is re-created.
+                self.dead = True
+            if self.dead or not self.skeleton_engine.enabled:
+                continue
+
+            t = time.time() - start
+            skeletons = []
+            for index in range(MAX_SKELETONS):
+                if index < self.num_players:
+                    positions = make_skeleton_positions(t, index * 0.8 - 0.4)
+                    skeletons.append(FakeSkeleton(tracked, positions))
+                else:
+                    skeletons.append(FakeSkeleton(not_tracked, {}))
+            self.skeleton_frame_ready.fire(FakeFrame(skeletons))
+
+    def close(self):
+        self.closed.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeKinect(object):
+    '''A factory for `FakeRuntime` objects which can be passed to
+    `kinect.KinectData` in place of `nui.Runtime`. Faults can be injected
+    while the server is running:
+
+        >>> fake = FakeKinect()
+        >>> kinect_data = kinect.KinectData(runtime_factory=fake)
+        >>> fake.stall()      # current runtime stops sending frames
+        >>> fake.unplug(5)    # ...and cannot be reopened for 5 seconds
+    '''
+    def __init__(self, num_players=1):
+        self.num_players = num_players
+        self.lock = threading.Lock()
+        self.stall_requested = False
+        self.unplugged_until = 0
+        self.opened = 0
+
+    def __call__(self):
+        runtime = FakeRuntime(self, self.num_players)
+        self.opened += 1
+        return runtime
+
+    def stall(self):
+        '''Makes the currently open runtime stop delivering frames.'''
+        with self.lock:
+            self.stall_requested = True
+
+    def unplug(self, seconds):
+        '''Simulates pulling out the USB cable for `seconds` seconds.'''
+        with self.lock:
+            self.unplugged_until = time.time() + seconds
+
+    def consume_stall(self):
+        with self.lock:
+            requested = self.stall_requested
+            self.stall_requested = False
+            return requested
+
+    def is_unplugged(self):
+        return time.time() < self.unplugged_until
+
+
+# The longest the fault check waits for the Kinect thread to recover, in
+# seconds.
+RECOVERY_TIMEOUT = 15
+
+
+def wait_for(condition, timeout=RECOVERY_TIMEOUT):
+    '''Polls `condition` until it returns true, and returns whether it did
+    before `timeout` seconds passed.'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def check_recovers(kinect_data, message, fault):
+    '''Injects a fault, then waits for the Kinect thread to reconnect.
+    Returns a description of what went wrong, or `None` if the status
+    returned to 'ok', the restart count went up and frames resumed.'''
+    print(message)
+    before = kinect_data.health()
+    fault()
+    if not wait_for(lambda: kinect_data.health()['restarts'] > before['restarts']):
+        return 'the Kinect thread never restarted'
+    restarted = kinect_data.health()
+    if not wait_for(lambda: kinect_data.health()['status'] == 'ok'):
+        return 'the status stayed {0!r}'.format(kinect_data.health()['status'])
+    if not wait_for(lambda: kinect_data.health()['frame_count'] > restarted['frame_count']):
+        return 'no frames arrived after reconnecting'
+    health = kinect_data.health()
+    print('  recovered: {0} restarts, {1} frames, last error {2!r}'.format(
+        health['restarts'], health['frame_count'], health['last_error']))
+    return None
+
+
+def main():
+    '''Runs the Kinect thread against a fake Kinect, injects a stall and
+    then an unplug, and checks that it reconnects after each. Exits with a
+    non-zero status if it doesn't.'''
+    import sys
+
+    import kinect
+
+    fake = FakeKinect()
+    kinect_data = kinect.KinectData(runtime_factory=fake, stall_timeout=1.0)
+    print("Starting fake Kinect")
+    kinect_data.start()
+
+    try:
+        if not wait_for(lambda: kinect_data.health()['status'] == 'ok'):
+            failure = 'the fake Kinect never started'
+        else:
+            failure = (
+                check_recovers(kinect_data, "Injecting stall", fake.stall) or
+                check_recovers(kinect_data, "Unplugging for 3 seconds",
+                               lambda: fake.unplug(3)))
+        if failure is None and kinect_data.match(1, 'Head') is None:
+            failure = 'the fake player is missing after reconnecting'
+    finally:
+        kinect_data.end()
+
+    if failure is not None:
+        print("FAILED: " + failure)
+        sys.exit(1)
+    print("Recovered from every fault; opened the fake Kinect {0} times".format(fake.opened))
+
+if __name__ == '__main__':
+    main()
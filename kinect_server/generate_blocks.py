@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+"""
+Generates the Snap block library (`block_definitions/kinect.xml`) from the
+joints the server knows about, along with a benchmark project
+(`block_definitions/kinect_benchmark.xml`).
+
+The library contains these groups of blocks:
+
+-   the original joint blocks, which issue one HTTP request per coordinate;
+-   cached blocks: a "kinect: refresh frame" command which fetches every
+    skeleton with a single request into the global `kinect frame` variable,
+    an index helper, and "kinect (cached)" reporters which read joints from
+    that local copy;
+-   measurement blocks, reporting joint angles and bone lengths;
+-   pose blocks, for saving poses and matching players against them;
+-   zone blocks, for setting and deleting zones, checking what is inside
+    them, and reading their enter and leave events.
+
+The benchmark project times the original and cached blocks against a
+running server.
+
+Run `python generate_blocks.py` after changing `kinect.JOINTS` or
+`server.ORDER`.
+"""
+
+from __future__ import print_function, division
+
+import os
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+import bones
+import kinect
+import server
+
+APP = 'Snap! 4.0, http://snap.berkeley.edu'
+HOST = 'localhost:5000'
+FRAME_VARIABLE = 'kinect frame'
+COORDS = ['X', 'Y', 'Z', 'W']
+PLAYERS = ['1', '2']
+
+# Number of frames timed by the benchmark project for each set of blocks.
+BENCHMARK_FRAMES = 30
+
+OUTPUT_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'block_definitions')
+
+
+def display_names():
+    '''Returns the names of the joints as they appear in Snap's dropdowns
+    (for example 'HandLeft'), in the order defined by `server.ORDER`.'''
+    names = dict(
+        (attribute.lower(), attribute)
+        for attribute in dir(kinect.JointId)
+        if attribute.lower() in kinect.JOINTS)
+    return [names[joint] for joint in server.ORDER]
+
+
+# Helpers for building Snap's XML format.
+
+def text(value):
+    return '<l>{0}</l>'.format(escape(str(value)))
+
+
+def option(value):
+    return '<l><option>{0}</option></l>'.format(escape(value))
+
+
+def var(name):
+    return '<block var={0}/>'.format(quoteattr(name))
+
+
+def block(selector, *inputs):
+    if not inputs:
+        return '<block s={0}/>'.format(quoteattr(selector))
+    return '<block s={0}>{1}</block>'.format(quoteattr(selector), ''.join(inputs))
+
+
+def custom(spec, *inputs):
+    return '<custom-block s={0}>{1}</custom-block>'.format(
+        quoteattr(spec), ''.join(inputs))
+
+
+def script(*blocks):
+    return '<script>{0}</script>'.format(''.join(blocks))
+
+
+def items(values):
+    return '<list>{0}</list>'.format(''.join(text(value) for value in values))
+
+
+def new_list(values):
+    return block('reportNewList', items(values))
+
+
+def url(*parts):
+    if len(parts) == 1:
+        return block('reportURL', parts[0])
+    return block('reportURL', block('reportJoinWords', '<list>{0}</list>'.format(''.join(parts))))
+
+
+def declare(*names):
+    return block('doDeclareVariables', items(names))
+
+
+def set_var(name, value):
+    return block('doSetVar', text(name), value)
+
+
+def change_var(name, delta):
+    return block('doChangeVar', text(name), text(delta))
+
+
+def report(value):
+    return block('doReport', value)
+
+
+def dropdown(options):
+    return '<input type="%s"><options>{0}</options></input>'.format(
+        escape('\n'.join(options)))
+
+
+def definition(spec, block_type, inputs, body, category='sensing'):
+    '''Returns a custom block definition. `spec` uses %'name' for inputs,
+    and `inputs` holds the matching <input> elements.'''
+    inputs = '<inputs>{0}</inputs>'.format(''.join(inputs)) if inputs else '<inputs/>'
+    return (
+        '<block-definition s={0} type={1} category={2}><header/><code/>'
+        '{3}{4}</block-definition>').format(
+            quoteattr(spec), quoteattr(block_type), quoteattr(category),
+            inputs, script(*body))
+
+
+def call_spec(spec):
+    '''Converts a definition spec into the form used when calling it.'''
+    return re.sub(r"%'[^']*'", '%s', spec)
+
+
+# Block definitions.
+
+JOINT_SPEC = "kinect: %'joint' -> %'coord' from player %'player number'"
+DEFAULT_JOINT_SPEC = "kinect: %'joint' -> %'coord' from default player"
+CONNECTED_SPEC = "kinect: is connected?"
+NUM_PLAYERS_SPEC = "kinect: number of players"
+REFRESH_SPEC = "kinect: refresh frame"
+INDEX_SPEC = "kinect: index of %'item' in %'list'"
+CACHED_JOINT_SPEC = "kinect (cached): %'joint' -> %'coord' from player %'player number'"
+CACHED_DEFAULT_JOINT_SPEC = "kinect (cached): %'joint' -> %'coord' from default player"
+ANGLE_SPEC = "kinect: angle at %'joint' of player %'player number'"
+BONE_SPEC = "kinect: length of bone to %'joint' of player %'player number'"
+SAVE_POSE_SPEC = "kinect: save pose %'name' from player %'player number'"
+POSE_SPEC = "kinect: closest pose of player %'player number'"
+POSE_DISTANCE_SPEC = "kinect: distance to closest pose of player %'player number'"
+BOX_ZONE_SPEC = ("kinect: set zone %'name' to box from x %'x1' y %'y1' z %'z1' "
+                 "to x %'x2' y %'y2' z %'z2'")
+SPHERE_ZONE_SPEC = "kinect: set zone %'name' to sphere at x %'x' y %'y' z %'z' radius %'radius'"
+DELETE_ZONE_SPEC = "kinect: delete zone %'name'"
+ZONE_COUNT_SPEC = "kinect: number of joints in zone %'name'"
+ZONE_OCCUPIED_SPEC = "kinect: is anything in zone %'name'?"
+ZONE_EVENTS_SPEC = "kinect: zone events after %'event id'"
+
+
+def joint_blocks(joints):
+    '''The original blocks, which request each coordinate from the server.'''
+    return [
+        definition(
+            JOINT_SPEC, 'reporter',
+            [dropdown(sorted(joints)), dropdown(COORDS), dropdown(PLAYERS)],
+            [report(url(
+                text(HOST + '/skeletons/'), var('player number'), text('/'),
+                var('joint'), text('/'), var('coord')))]),
+        definition(
+            DEFAULT_JOINT_SPEC, 'reporter',
+            [dropdown(sorted(joints)), dropdown(COORDS)],
+            [report(url(
+                text(HOST + '/skeletons/0/'), var('joint'), text('/'),
+                var('coord')))]),
+        definition(
+            CONNECTED_SPEC, 'predicate', [],
+            [block(
+                'doIfElse',
+                block('reportEquals', url(text(HOST + '/heartbeat')), text('ok')),
+                script(report(block('reportTrue'))),
+                script(report(block('reportFalse'))))]),
+        definition(
+            NUM_PLAYERS_SPEC, 'reporter', [],
+            [report(url(text(HOST + '/num_tracked')))])
+    ]
+
+
+def cached_blocks(joints):
+    '''Blocks which fetch the whole frame once with `refresh frame`, and
+    then read joints out of the `kinect frame` variable without any further
+    requests. Each line of the frame is the RAW data for one joint: the
+    joints of player 1 in `server.ORDER`, followed by those of player 2.'''
+    hipcenter = server.ORDER.index('hipcenter') + 1
+    empty_joint = ' '.join(['0'] * len(COORDS))
+
+    def frame_line(player, joint_index):
+        return block(
+            'reportListItem',
+            block(
+                'reportSum',
+                block(
+                    'reportProduct',
+                    block('reportDifference', player, text(1)),
+                    text(len(joints))),
+                joint_index),
+            var(FRAME_VARIABLE))
+
+    return [
+        definition(
+            REFRESH_SPEC, 'command', [],
+            [set_var(FRAME_VARIABLE, block(
+                'reportTextSplit',
+                url(text(HOST + '/skeletons')),
+                option('line')))]),
+        definition(
+            INDEX_SPEC, 'reporter',
+            ['<input type="%s"/>', '<input type="%l"/>'],
+            [declare('index'),
+             set_var('index', text(1)),
+             # Snap waits for the next display frame after each pass of a
+             # loop, unless it runs inside "warp".
+             block('doWarp', script(block(
+                 'doUntil',
+                 block(
+                     'reportOr',
+                     block(
+                         'reportGreaterThan', var('index'),
+                         block('reportListLength', var('list'))),
+                     block(
+                         'reportEquals',
+                         block('reportListItem', var('index'), var('list')),
+                         var('item'))),
+                 script(change_var('index', 1))))),
+             report(var('index'))],
+            category='lists'),
+        definition(
+            CACHED_JOINT_SPEC, 'reporter',
+            [dropdown(sorted(joints)), dropdown(COORDS), dropdown(['0'] + PLAYERS)],
+            [declare('player'),
+             set_var('player', var('player number')),
+             # Player 0 is the lowest-numbered tracked player, as on the
+             # server. Untracked players have all of their joints zeroed.
+             block(
+                 'doIf',
+                 block('reportEquals', var('player number'), text(0)),
+                 script(
+                     set_var('player', text(1)),
+                     block(
+                         'doIf',
+                         block(
+                             'reportEquals',
+                             frame_line(text(1), text(hipcenter)),
+                             text(empty_joint)),
+                         script(set_var('player', text(2)))))),
+             report(block(
+                 'reportListItem',
+                 custom(call_spec(INDEX_SPEC), var('coord'), new_list(COORDS)),
+                 block(
+                     'reportTextSplit',
+                     frame_line(
+                         var('player'),
+                         custom(call_spec(INDEX_SPEC), var('joint'), new_list(joints))),
+                     option('whitespace'))))]),
+        definition(
+            CACHED_DEFAULT_JOINT_SPEC, 'reporter',
+            [dropdown(sorted(joints)), dropdown(COORDS)],
+            [report(custom(
+                call_spec(CACHED_JOINT_SPEC), var('joint'), var('coord'),
+                text(0)))])
+    ]
+
+
+def measurement_blocks(joints):
+    '''Blocks reporting the joint angles and bone lengths which the server
+    measures on every frame.'''
+    def named(names):
+        return dropdown(sorted(joint for joint in joints if joint.lower() in names))
+
+    players = dropdown(['0'] + PLAYERS)
+    return [
+        definition(
+            ANGLE_SPEC, 'reporter', [named(bones.ANGLE_NAMES), players],
+            [report(url(
+                text(HOST + '/skeletons/'), var('player number'),
+                text('/angles/'), var('joint')))]),
+        definition(
+            BONE_SPEC, 'reporter', [named(bones.BONE_NAMES), players],
+            [report(url(
+                text(HOST + '/skeletons/'), var('player number'),
+                text('/bones/'), var('joint')))])
+    ]
+
+
+def pose_blocks():
+    '''Blocks for saving reference poses, and for finding out which saved
+    pose a player is closest to.'''
+    players = dropdown(['0'] + PLAYERS)
+    return [
+        definition(
+            SAVE_POSE_SPEC, 'command', ['<input type="%s"/>', players],
+            [report(url(
+                text(HOST + '/skeletons/'), var('player number'),
+                text('/save_pose/'), var('name')))]),
+        definition(
+            POSE_SPEC, 'reporter', [players],
+            [report(url(
+                text(HOST + '/skeletons/'), var('player number'), text('/pose')))]),
+        definition(
+            POSE_DISTANCE_SPEC, 'reporter', [players],
+            [report(url(
+                text(HOST + '/skeletons/'), var('player number'),
+                text('/pose/distance')))])
+    ]
+
+
+def zone_blocks():
+    '''Blocks for adding and removing zones, and for checking what is
+    inside them.'''
+    name = '<input type="%s"/>'
+    number = '<input type="%n"/>'
+
+    def query(*names):
+        parts = []
+        for index, input_name in enumerate(names):
+            parts.append(text(('?' if index == 0 else '&') + input_name + '='))
+            parts.append(var(input_name))
+        return parts
+
+    return [
+        definition(
+            BOX_ZONE_SPEC, 'command', [name] + [number] * 6,
+            [report(url(*(
+                [text(HOST + '/zones/'), var('name'), text('/box')] +
+                query('x1', 'y1', 'z1', 'x2', 'y2', 'z2'))))]),
+        definition(
+            SPHERE_ZONE_SPEC, 'command', [name] + [number] * 4,
+            [report(url(*(
+                [text(HOST + '/zones/'), var('name'), text('/sphere')] +
+                query('x', 'y', 'z', 'radius'))))]),
+        definition(
+            DELETE_ZONE_SPEC, 'command', [name],
+            [report(url(text(HOST + '/zones/'), var('name'), text('/delete')))]),
+        definition(
+            ZONE_COUNT_SPEC, 'reporter', [name],
+            [report(url(text(HOST + '/zones/'), var('name')))]),
+        definition(
+            ZONE_OCCUPIED_SPEC, 'predicate', [name],
+            [report(block(
+                'reportGreaterThan',
+                url(text(HOST + '/zones/'), var('name')), text(0)))]),
+        definition(
+            ZONE_EVENTS_SPEC, 'reporter', [number],
+            [report(url(text(HOST + '/zone_events?since='), var('event id')))])
+    ]
+
+
+def global_variables(names):
+    return '<variables>{0}</variables>'.format(''.join(
+        '<variable name={0}>{1}</variable>'.format(quoteattr(name), text(0))
+        for name in names))
+
+
+def library(joints):
+    '''Returns the XML for the block library.'''
+    return '<blocks app={0} version="1">{1}{2}</blocks>'.format(
+        quoteattr(APP),
+        ''.join(
+            joint_blocks(joints) + cached_blocks(joints) +
+            measurement_blocks(joints) + pose_blocks() + zone_blocks()),
+        global_variables([FRAME_VARIABLE]))
+
+
+def benchmark_project(joints):
+    '''Returns the XML for a project which, when the green flag is clicked,
+    reads the X and Y coordinates of every joint of player 1 for
+    BENCHMARK_FRAMES frames, first with the original blocks and then with
+    the cached blocks, and reports the requests per second and the time
+    taken per frame for each.'''
+    coords = ['X', 'Y']
+
+    def read_all_joints(reporter_spec):
+        reads = []
+        for coord in coords:
+            reads.append(set_var('value', custom(
+                call_spec(reporter_spec),
+                block('reportListItem', var('joint index'), var('joints')),
+                text(coord), text(1))))
+        return [
+            set_var('joint index', text(1)),
+            block(
+                'doRepeat',
+                block('reportListLength', var('joints')),
+                script(*(reads + [change_var('joint index', 1)])))]
+
+    def timed(prefix, requests_per_frame, body):
+        elapsed = block('getTimer')
+        return [
+            block('doResetTimer'),
+            block('doRepeat', text(BENCHMARK_FRAMES), script(*body)),
+            set_var(prefix + ' frame latency (ms)', block(
+                'reportQuotient',
+                block('reportProduct', elapsed, text(1000)),
+                text(BENCHMARK_FRAMES))),
+            set_var(prefix + ' requests per second', block(
+                'reportQuotient',
+                text(BENCHMARK_FRAMES * requests_per_frame),
+                elapsed))]
+
+    variables = [
+        FRAME_VARIABLE, 'joints', 'joint index', 'value',
+        'old requests per second', 'old frame latency (ms)',
+        'cached requests per second', 'cached frame latency (ms)']
+    body = (
+        [block('receiveGo'), set_var('joints', new_list(joints))] +
+        timed('old', len(joints) * len(coords), read_all_joints(JOINT_SPEC)) +
+        timed('cached', 1,
+              [custom(call_spec(REFRESH_SPEC))] +
+              read_all_joints(CACHED_JOINT_SPEC)))
+    watchers = ''.join(
+        '<watcher var={0} style="normal" x="10" y="{1}" color="243,118,29" shown="true"/>'.format(
+            quoteattr(name), 10 + 24 * index)
+        for index, name in enumerate(variables[4:]))
+
+    return (
+        '<project name="kinect_benchmark" app={0} version="1">'
+        '<notes>{1}</notes>'
+        '<stage name="Stage" width="480" height="360" costume="0" tempo="60" '
+        'threadsafe="false" lines="round" codify="false" scheduled="false">'
+        '<costumes><list/></costumes><sounds><list/></sounds><variables/>'
+        '<blocks/><scripts><script x="20" y="20">{2}</script></scripts>'
+        '<sprites>{3}</sprites></stage><hidden/><headers/><code/>'
+        '<blocks>{4}</blocks>{5}</project>').format(
+            quoteattr(APP),
+            escape(
+                'Click the green flag with the Kinect server running to '
+                'compare the original blocks, which make one request per '
+                'coordinate, with the cached blocks, which make one request '
+                'per frame.'),
+            ''.join(body),
+            watchers,
+            ''.join(joint_blocks(joints) + cached_blocks(joints)),
+            global_variables(variables))
+
+
+def write(filename, contents):
+    path = os.path.normpath(os.path.join(OUTPUT_DIRECTORY, filename))
+    with open(path, 'w') as stream:
+        stream.write(contents)
+    print("Wrote " + path)
+
+
+def main():
+    joints = display_names()
+    write('kinect.xml', library(joints))
+    write('kinect_benchmark.xml', benchmark_project(joints))
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,24 @@ skeletal data.
 
 from __future__ import print_function, division
 
-from pykinect import nui
-from pykinect.nui import JointId
+try:
+    from pykinect import nui
+    from pykinect.nui import JointId
+except ImportError:
+    # Without pykinect, only the synthetic frames from fake_kinect.py can be
+    # used (see the `runtime_factory` argument of `KinectData`).
+    from fake_kinect import nui, JointId
 
 import heapq
+import sys
 import time
 import threading
+import traceback
+
+import numpy
+
+import bones
+import prediction
 
 # BYOB screen's coordinate system starts from -240 to 240 along the x axis, and
 # -180 to 180 along the y axis.
@@ -19,6 +31,14 @@ WIDTH = 240 * 2
 HEIGHT = 180 * 2
 NUM_PLAYERS = 2
 
+# The supervisor treats the Kinect as stalled if no frames arrive within this
+# many seconds, and waits between MIN_BACKOFF and MAX_BACKOFF seconds
+# (doubling after each consecutive failure) before reconnecting.
+STALL_TIMEOUT = 2.0
+SUPERVISOR_INTERVAL = 0.25
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
 JOINTS = {
     'ankleleft': JointId.AnkleLeft,
     'ankleright': JointId.AnkleRight,
@@ -57,7 +77,42 @@ def normalize(pos):
 
 
 def get_player_ids(num_players):
-    return range(1, num_players + 1)
+    return list(range(1, num_players + 1))
+
+
+class FrameStats(object):
+    '''Keeps running totals about the frames delivered by the Kinect. A
+    single instance is shared by every `KinectProcess` created by a
+    `KinectData` object, so the totals survive reconnects.'''
+    def __init__(self):
+        self.frame_count = 0
+        self.callback_time = 0.0
+        self.last_frame_time = None
+        self.started_time = time.time()
+
+    def mark_started(self):
+        '''Records that a new Kinect runtime is being brought up.'''
+        self.started_time = time.time()
+        self.last_frame_time = None
+
+    def count_frame(self):
+        '''Records that a frame arrived. Called with the data lock held,
+        before the listeners run, so the frame number always matches the
+        data.'''
+        self.frame_count += 1
+        self.last_frame_time = time.time()
+
+    def record_frame(self, duration):
+        '''Records that a frame was processed in `duration` seconds.'''
+        self.callback_time += duration
+
+    def seconds_since_frame(self):
+        '''Returns the number of seconds since the last frame arrived, or
+        since the runtime was started if no frame has arrived yet.'''
+        last = self.last_frame_time
+        if last is None:
+            last = self.started_time
+        return time.time() - last
 
 
 class KinectProcess(threading.Thread):
@@ -65,13 +120,24 @@ class KinectProcess(threading.Thread):
     its internal data with each frame update. To start the process, call
     the 'start' method; to end it call the 'stop' method (NOT the
     `join` method).'''
-    def __init__(self, data, lock):
+    def __init__(self, data, lock, stats=None, runtime_factory=None,
+                 listeners=None):
         '''Accepts a dictionary to store `data` and a `Threading.lock` object
         to synchronize the data.
+
+        `stats` is an optional `FrameStats` object to record frame timings
+        in, and `runtime_factory` is an optional callable used in place of
+        `nui.Runtime` to open the Kinect. `listeners` is an optional list of
+        callables which are passed the data dictionary (with the lock held)
+        after every frame, and once with nobody tracked when the process is
+        created.
         '''
         super(KinectProcess, self).__init__(name='KinectProcess')
         self.data = data
         self.lock = lock
+        self.stats = stats if stats is not None else FrameStats()
+        self.runtime_factory = runtime_factory
+        self.listeners = listeners if listeners is not None else []
 
         self.stop_flag = threading.Event()
         self.kinect_ready_flag = threading.Event()
@@ -79,6 +145,7 @@ class KinectProcess(threading.Thread):
         self.exception = None
         
         self.prev = []
+        self.failed_listeners = []
         
         self.players = {}
         self.available = get_player_ids(NUM_PLAYERS)
@@ -91,7 +158,16 @@ class KinectProcess(threading.Thread):
             self.data['num_tracked'] = 0
             self.data['tracked_players'] = []
             self.data['skeletons'] = {}
+            self.data['angles'] = {}
+            self.data['bones'] = {}
+            self.data['motion'] = {}
+            # The listeners' results for the previous connection no longer
+            # apply; `get_pose` and `get_zone` treat missing entries as empty.
+            self.data['poses'] = {}
+            self.data['zones'] = {}
             for i in get_player_ids(num_players):
+                self.data['angles'][i] = bones.empty_angles()
+                self.data['bones'][i] = bones.empty_lengths()
                 self.data['skeletons'][i] = {}
                 for name in JOINTS:
                     self.data['skeletons'][i][name] = {
@@ -100,18 +176,29 @@ class KinectProcess(threading.Thread):
                         'z': 0,
                         'w': 0
                     }
+            # Lets the listeners catch up with nobody being tracked, so that
+            # joints leave their zones now rather than when frames resume.
+            self._call_listeners()
 
     def _set_data(self, player_number, skeleton):
-        '''Synchronizes the skeleton data'''
+        '''Synchronizes the skeleton data, along with the joint angles and
+        bone lengths measured from it.'''
+        positions = numpy.empty((len(bones.JOINT_NAMES), 3))
         with self.lock:
             for name, joint_id in JOINTS.items():
                 pos = skeleton.SkeletonPositions[joint_id]
+                positions[bones.INDEX[name]] = (pos.x, pos.y, pos.z)
                 normalized = normalize(pos)
                 for coord in 'xyzw':
                     self._set_coord(player_number, name, coord, normalized[coord])
+            angles, lengths = bones.measure(positions)
+            self.data['angles'][player_number] = angles
+            self.data['bones'][player_number] = lengths
                     
     def _clear_data(self, player_number):
         with self.lock:
+            self.data['angles'][player_number] = bones.empty_angles()
+            self.data['bones'][player_number] = bones.empty_lengths()
             for name in JOINTS:
                 self.data['skeletons'][player_number][name] = {
                     'x': 0,
@@ -120,6 +207,20 @@ class KinectProcess(threading.Thread):
                     'w': 0
                 }
 
+    def _call_listeners(self):
+        '''Passes the data to every listener. A listener which raises is
+        reported, but doesn't stop the others or the frame being counted.'''
+        for listener in self.listeners:
+            try:
+                listener(self.data)
+            except Exception:
+                # Only reported the first time, so a listener which fails on
+                # every frame doesn't flood the console.
+                if listener not in self.failed_listeners:
+                    self.failed_listeners.append(listener)
+                    print("Kinect listener {0!r} failed:".format(listener), file=sys.stderr)
+                    traceback.print_exc()
+
     def _set_coord(self, skeleton_number, joint_name, coord, value):
         self.data['skeletons'][skeleton_number][joint_name][coord] = value
 
@@ -128,6 +229,9 @@ class KinectProcess(threading.Thread):
         def display(frame):
             '''Will be called every time the Kinect has a new frame.
             Processes and synchronizes that data.'''
+            if self.is_stopped():
+                return
+            start = time.time()
             tracked_enum = nui.SkeletonTrackingState.TRACKED
             index = 1
             current = []
@@ -139,7 +243,7 @@ class KinectProcess(threading.Thread):
             
             if self.prev != current:
                 self.prev = current
-                for index, player_number in self.players.items():
+                for index, player_number in list(self.players.items()):
                     if index not in data:
                         # player with that id just left
                         self.available.append(player_number)
@@ -160,9 +264,15 @@ class KinectProcess(threading.Thread):
                     
             self.data['num_tracked'] = index
             self.data['tracked_players'] = list(self.players.values())
+            with self.lock:
+                self.stats.count_frame()
+                self._call_listeners()
+            self.stats.record_frame(time.time() - start)
 
+        runtime_factory = self.runtime_factory or nui.Runtime
+        self.stats.mark_started()
         try:
-            with nui.Runtime() as kinect:
+            with runtime_factory() as kinect:
                 kinect.skeleton_engine.enabled = True
                 kinect.skeleton_frame_ready += display
 
@@ -187,9 +297,8 @@ class KinectProcess(threading.Thread):
 
     def _block(self):
         '''Blocks the thread until the thread is manually stopped.'''
-        while True:
-            if self.is_stopped():
-                break
+        while not self.is_stopped():
+            self.stop_flag.wait(SUPERVISOR_INTERVAL)
 
     def stop(self):
         '''Calling this method will (eventually) stop this thread.'''
@@ -210,28 +319,149 @@ class KinectProcess(threading.Thread):
         return self.encountered_error_flag.isSet()
 
 
+class KinectSupervisor(threading.Thread):
+    '''Watches the Kinect thread owned by a `KinectData` object, and tears
+    down and re-creates it whenever it fails or stops delivering frames.
+    Reconnect attempts back off exponentially while the Kinect stays
+    unavailable.'''
+    def __init__(self, kinect_data, stall_timeout=STALL_TIMEOUT):
+        super(KinectSupervisor, self).__init__(name='KinectSupervisor')
+        self.daemon = True
+        self.kinect_data = kinect_data
+        self.stall_timeout = stall_timeout
+        self.stop_flag = threading.Event()
+
+        self.status = 'starting'
+        self.restarts = 0
+        self.failures = 0
+        self.last_error = None
+
+    def run(self):
+        '''Periodically checks the Kinect thread until stopped.'''
+        while not self.is_stopped():
+            self.stop_flag.wait(SUPERVISOR_INTERVAL)
+            if self.is_stopped():
+                break
+
+            problem = self._find_problem()
+            if problem is None:
+                continue
+
+            self.status = 'reconnecting'
+            self.last_error = problem
+            delay = min(MIN_BACKOFF * 2 ** self.failures, MAX_BACKOFF)
+            self.failures += 1
+            self.stop_flag.wait(delay)
+            if self.is_stopped():
+                break
+            self.kinect_data.restart()
+            self.restarts += 1
+
+    def _find_problem(self):
+        '''Returns a description of what is wrong with the Kinect thread,
+        or `None` if it is healthy (or still starting up).'''
+        process = self.kinect_data.process
+        if process.encountered_error():
+            return repr(process.exception)
+        if not process.is_alive():
+            return 'Kinect thread exited'
+        stalled_for = self.kinect_data.stats.seconds_since_frame()
+        if stalled_for > self.stall_timeout:
+            return 'No frames for {0:.1f} seconds'.format(stalled_for)
+        if self.kinect_data.stats.last_frame_time is not None:
+            self.status = 'ok'
+            self.failures = 0
+        return None
+
+    def stop(self):
+        '''Calling this method will (eventually) stop this thread.'''
+        self.stop_flag.set()
+
+    def is_stopped(self):
+        '''Returns `true` if the supervisor has been told to stop.'''
+        return self.stop_flag.isSet()
+
+
 class KinectData(object):
     '''A wrapper object providing better support for retrieving data
     from the Kinect process'''
-    def __init__(self):
-        '''Initializes the wrapper and the underlying thread.'''
+    def __init__(self, runtime_factory=None, stall_timeout=STALL_TIMEOUT):
+        '''Initializes the wrapper and the underlying thread.
+
+        `runtime_factory` is an optional callable used in place of
+        `nui.Runtime` (for example, a `fake_kinect.FakeKinect` object), and
+        `stall_timeout` is the number of seconds without frames after which
+        the Kinect is reconnected.'''
         self.data = {}
         self.lock = threading.Lock()
-        self.process = KinectProcess(self.data, self.lock)
-        self.process.daemon = True
+        self.stats = FrameStats()
+        self.runtime_factory = runtime_factory
+        self.listeners = []
+        self.process = self._create_process()
+        self.supervisor = KinectSupervisor(self, stall_timeout)
+
+    def _create_process(self):
+        process = KinectProcess(
+            self.data, self.lock, self.stats, self.runtime_factory,
+            self.listeners)
+        process.daemon = True
+        return process
 
     def start(self):
-        '''Starts the underlying Kinect thread.'''
+        '''Starts the underlying Kinect thread, and the supervisor which
+        keeps it running.'''
         self.process.start()
         while not self.process.is_ready():
             time.sleep(0.5)
         if self.process.encountered_error():
             raise self.process.exception
+        self.supervisor.start()
+
+    def restart(self):
+        '''Tears down the underlying Kinect thread and replaces it with a
+        fresh one. The data dictionary (and anything holding a reference to
+        it) is kept, but the skeletons are reset until new frames arrive.'''
+        old = self.process
+        old.stop()
+        old.join(MAX_BACKOFF)
+        self.process = self._create_process()
+        self.process.start()
 
     def end(self):
         '''Ends the underlying Kinect thread.'''
+        self.supervisor.stop()
         self.process.stop()
 
+    def add_listener(self, listener):
+        '''Registers a callable which is passed the data dictionary after
+        every frame, from the Kinect thread and with the lock held. Listeners
+        can add their own per-frame results to the dictionary. It is also
+        called with nobody tracked whenever the Kinect reconnects.'''
+        self.listeners.append(listener)
+
+    def health(self):
+        '''Returns a dictionary describing the state of the connection to
+        the Kinect. The 'status' field is one of 'starting', 'ok', or
+        'reconnecting'.'''
+        supervisor = self.supervisor
+        return {
+            'status': supervisor.status,
+            'restarts': supervisor.restarts,
+            'last_error': supervisor.last_error,
+            'seconds_since_frame': self.stats.seconds_since_frame(),
+            'frame_count': self.stats.frame_count
+        }
+
+    def refresh(self):
+        '''Brings `data` up to date. The Kinect thread updates `data` in
+        place, so there is nothing to do here; see
+        `workers.SharedKinectData` for a wrapper where there is.'''
+        pass
+
+    def get_frame_number(self):
+        '''Returns the number of frames received from the Kinect.'''
+        return self.stats.frame_count
+
     def match(self, skeleton_number=None, joint=None, coord=None):
         '''Returns all joint data that corresponds to the provided
         skeleton, joint, and coord. Will perform a case-insensitive match.
@@ -253,12 +483,7 @@ class KinectData(object):
         '''
         joint = self._format_key(joint)
         coord = self._format_key(coord)
-        
-        if skeleton_number == 0:
-            if self.data['num_tracked'] > 0:
-                skeleton_number = min(self.data['tracked_players'])
-            else:
-                skeleton_number = 1
+        skeleton_number = self._resolve_player(skeleton_number)
 
         if skeleton_number is None:
             return self.data['skeletons']
@@ -269,6 +494,84 @@ class KinectData(object):
         else:
             return self.data['skeletons'][skeleton_number][joint][coord]
 
+    def predict(self, milliseconds, skeleton_number=None, joint=None, coord=None):
+        '''Like `match`, but returns where the joints are predicted to be
+        `milliseconds` from now (at most `prediction.MAX_PREDICTION`). Falls
+        back to the latest positions for players without a prediction yet,
+        when no frame has arrived for `prediction.MAX_FRAME_GAP` seconds,
+        and for the 'w' coordinate.'''
+        joint = self._format_key(joint)
+        coord = self._format_key(coord)
+        skeleton_number = self._resolve_player(skeleton_number)
+        milliseconds = max(0, min(milliseconds, prediction.MAX_PREDICTION))
+        now = time.time()
+
+        if skeleton_number is None:
+            return dict(
+                (player, self._predict_skeleton(player, now, milliseconds))
+                for player in self.data['skeletons'])
+        skeleton = self._predict_skeleton(skeleton_number, now, milliseconds, joint, coord)
+        if joint is None:
+            return skeleton
+        elif coord is None:
+            return skeleton[joint]
+        else:
+            return skeleton[joint][coord]
+
+    def _predict_skeleton(self, player, now, milliseconds, only_joint=None, only_coord=None):
+        skeleton = self.data['skeletons'][player]
+        motion = self.data.get('motion', {}).get(player)
+        if motion is None or now - motion['time'] > prediction.MAX_FRAME_GAP:
+            # Don't extrapolate through a stall or a reconnect.
+            return skeleton
+        seconds = now - motion['time'] + milliseconds / 1000
+        positions, velocities = motion['positions'], motion['velocities']
+        predicted = {}
+        for joint in ([only_joint] if only_joint is not None else skeleton):
+            values = dict(skeleton[joint])
+            for coord in ([only_coord] if only_coord is not None else prediction.COORDS):
+                if coord in prediction.COORDS:
+                    values[coord] = positions[joint][coord] + velocities[joint][coord] * seconds
+            predicted[joint] = values
+        return predicted
+
+    def match_angle(self, skeleton_number, joint=None):
+        '''Returns the angle in degrees at the given joint of the given
+        skeleton, or all of its joint angles if no joint is provided.'''
+        angles = self.data['angles'][self._resolve_player(skeleton_number)]
+        if joint is None:
+            return angles
+        return angles[self._format_key(joint)]
+
+    def match_bone(self, skeleton_number, joint=None):
+        '''Returns the length in millimeters of the bone ending at the given
+        joint of the given skeleton, or all of its bone lengths if no joint
+        is provided.'''
+        lengths = self.data['bones'][self._resolve_player(skeleton_number)]
+        if joint is None:
+            return lengths
+        return lengths[self._format_key(joint)]
+
+    def get_pose(self, skeleton_number):
+        '''Returns the saved pose closest to the given skeleton, as a
+        dictionary with 'name' and 'distance' keys. The name is empty if the
+        skeleton isn't tracked or no poses are saved.'''
+        skeleton_number = self._resolve_player(skeleton_number)
+        return self.data.get('poses', {}).get(
+            skeleton_number, {'name': '', 'distance': 0})
+
+    def get_zone(self, name):
+        '''Returns the joints inside the zone with the given name, as a
+        list of dictionaries with 'player' and 'joint' keys. Zones which
+        haven't been tested against a frame yet are empty.'''
+        return self.data.get('zones', {}).get(name, [])
+
+    def get_zone_events(self, since=0):
+        '''Returns the recent events of joints entering and leaving zones
+        with an id greater than `since`, oldest first.'''
+        return [event for event in self.data.get('zone_events', [])
+                if event['id'] > since]
+
     def get_num_tracked(self):
         '''Returns the number of skeletons currently being tracked.'''
         return self.data['num_tracked']
@@ -284,6 +587,16 @@ class KinectData(object):
         '''
         return self.data['tracked_players']
 
+    def _resolve_player(self, skeleton_number):
+        '''Skeleton 0 refers to the lowest-numbered tracked player, or to
+        player 1 if nobody is tracked.'''
+        if skeleton_number == 0:
+            if self.data['num_tracked'] > 0 and self.data['tracked_players']:
+                return min(self.data['tracked_players'])
+            else:
+                return 1
+        return skeleton_number
+
     def _format_key(self, value):
         if value is None:
             return None
@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+"""
+Simulates a classroom of Snap browsers polling the Kinect server, to check
+how it holds up before the lesson does.
+
+The server is started in a separate process, serving synthetic frames from
+`fake_kinect`, and many simulated clients then request it over HTTP in the
+same ways Snap projects do:
+
+    blocks   - the `kinect.xml` blocks: one request per coordinate, for the
+               x and y of several joints every frame
+    raw      - `/skeletons` once a frame, like the cached Snap blocks
+    json     - `/skeletons?format=json` once a frame, like the demo page
+    tracked  - `/tracked_players` once a frame
+
+The clients are spread over several processes so that they are not held
+back by contending for a single interpreter. Every REPORT_INTERVAL seconds,
+and again at the end, the throughput, p50 and p99 latency, error rate, and
+server CPU and memory use are printed. CPU and memory are read from /proc, so
+are only available on Linux; with `--workers`, they are totals over the
+server and its worker processes.
+
+Example (35 clients for an hour, saving the results to compare later runs):
+
+    python loadtest.py --clients 35 --duration 3600 --output soak.json
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+from dashboard import percentile
+import server
+
+PORT = 5001
+REPORT_INTERVAL = 10
+
+# How often each client process sends its results to the main process.
+BATCH_INTERVAL = 1.0
+
+# Default proportion of clients behaving in each way.
+DEFAULT_MIX = 'blocks=0.6,raw=0.2,json=0.1,tracked=0.1'
+
+# Number of joints each `blocks` client reads every frame. The demo project
+# moves seven sprites, reading the x and y of a joint for each.
+JOINTS_PER_FRAME = 7
+
+
+def run_server(port, num_players):
+    '''Runs the server with a fake Kinect. Used as the target of the server
+    process.'''
+    import fake_kinect
+
+    app, kinect_data = server.setup(fake_kinect.FakeKinect(num_players))
+    kinect_data.start()
+    server.run_production_webserver(app, port)
+
+
+def run_pooled_server(port, num_players, num_workers):
+    '''Runs the server with a fake Kinect and `num_workers` worker
+    processes. Used as the target of the server process.'''
+    import fake_kinect
+    import workers
+
+    pool = workers.WorkerPool(num_workers, port, fake_kinect.FakeKinect(num_players))
+    pool.kinect_data.start()
+    pool.serve_forever()
+
+
+def frame_paths(kind, rng):
+    '''Returns the paths a client of the given kind requests every frame.'''
+    if kind == 'blocks':
+        joints = rng.sample(server.ORDER, JOINTS_PER_FRAME)
+        return [
+            '/skeletons/1/{0}/{1}'.format(joint, coord)
+            for joint in joints for coord in 'xy']
+    elif kind == 'raw':
+        return ['/skeletons']
+    elif kind == 'json':
+        return ['/skeletons?format=json']
+    elif kind == 'tracked':
+        return ['/tracked_players']
+    raise ValueError('Unknown kind of client: ' + kind)
+
+
+def parse_mix(mix):
+    '''Parses a mix such as 'blocks=0.6,raw=0.4' into a list of
+    (kind, weight) pairs.'''
+    pairs = []
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        pairs.append((kind.strip(), float(weight)))
+    return pairs
+
+
+def assign_kinds(mix, clients):
+    '''Splits `clients` clients between kinds in proportion to the mix,
+    by the largest remainder method. If there are enough clients, every
+    kind with a non-zero weight gets at least one.'''
+    total = sum(weight for kind, weight in mix)
+    shares = [clients * weight / total for kind, weight in mix]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(mix)), key=lambda i: counts[i] - shares[i])
+    for index in by_remainder[:clients - sum(counts)]:
+        counts[index] += 1
+
+    active = [index for index, (kind, weight) in enumerate(mix) if weight > 0]
+    if clients >= len(active):
+        for index in active:
+            if not counts[index]:
+                largest = max(range(len(mix)), key=lambda i: counts[i])
+                counts[largest] -= 1
+                counts[index] += 1
+
+    kinds = []
+    for (kind, weight), count in zip(mix, counts):
+        kinds.extend([kind] * count)
+    return kinds
+
+
+class Results(object):
+    '''Collects request latencies and errors, both for the current
+    interval and for the whole run.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.interval = self._empty()
+        self.total = self._empty()
+
+    def _empty(self):
+        return {'latencies': {}, 'errors': 0, 'kind_errors': {}, 'requests': 0}
+
+    def record(self, kind, latency, ok):
+        with self.lock:
+            for results in (self.interval, self.total):
+                results['requests'] += 1
+                if ok:
+                    results['latencies'].setdefault(kind, []).append(latency)
+                else:
+                    results['errors'] += 1
+                    results['kind_errors'][kind] = results['kind_errors'].get(kind, 0) + 1
+
+    def merge(self, batch):
+        '''Adds results taken from another `Results` object.'''
+        with self.lock:
+            for results in (self.interval, self.total):
+                results['requests'] += batch['requests']
+                results['errors'] += batch['errors']
+                for kind, errors in batch['kind_errors'].items():
+                    results['kind_errors'][kind] = results['kind_errors'].get(kind, 0) + errors
+                for kind, latencies in batch['latencies'].items():
+                    results['latencies'].setdefault(kind, []).extend(latencies)
+
+    def take_interval(self):
+        with self.lock:
+            interval = self.interval
+            self.interval = self._empty()
+            return interval
+
+
+def summarize(results, elapsed):
+    '''Returns throughput, latency percentiles in milliseconds, and error
+    rate for a set of results, overall and for each kind of client.'''
+    def stats(latencies, requests, errors):
+        latencies = sorted(latencies)
+        p50 = percentile(latencies, 50)
+        p99 = percentile(latencies, 99)
+        return {
+            'requests_per_second': requests / elapsed,
+            'p50_ms': None if p50 is None else p50 * 1000,
+            'p99_ms': None if p99 is None else p99 * 1000,
+            'error_rate': errors / requests if requests else 0.0
+        }
+
+    everything = [
+        latency for latencies in results['latencies'].values()
+        for latency in latencies]
+    summary = stats(everything, results['requests'], results['errors'])
+    summary['kinds'] = {}
+    for kind in set(results['latencies']) | set(results['kind_errors']):
+        latencies = results['latencies'].get(kind, [])
+        errors = results['kind_errors'].get(kind, 0)
+        summary['kinds'][kind] = stats(latencies, len(latencies) + errors, errors)
+    return summary
+
+
+class Client(threading.Thread):
+    '''A simulated Snap browser. Like Snap's synchronous `url` block, it
+    waits for each response before sending the next request, and runs one
+    frame of requests every `frame_interval` seconds.'''
+    def __init__(self, number, kind, port, frame_interval, results, stop_flag):
+        super(Client, self).__init__(name='Client{0}'.format(number))
+        self.daemon = True
+        self.kind = kind
+        self.port = port
+        self.frame_interval = frame_interval
+        self.results = results
+        self.stop_flag = stop_flag
+        self.rng = random.Random(number)
+        self.connection = None
+
+    def _request(self, path):
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection('localhost', self.port, timeout=10)
+        start = time.time()
+        try:
+            self.connection.request('GET', path)
+            response = self.connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (httplib.HTTPException, socket.error):
+            self.connection.close()
+            self.connection = None
+            ok = False
+        self.results.record(self.kind, time.time() - start, ok)
+
+    def run(self):
+        while not self.stop_flag.is_set():
+            start = time.time()
+            for path in frame_paths(self.kind, self.rng):
+                self._request(path)
+            remaining = self.frame_interval - (time.time() - start)
+            if remaining > 0:
+                self.stop_flag.wait(remaining)
+
+
+def read_stat(pid):
+    '''Returns the fields of /proc/<pid>/stat after the command name, or
+    `None` if the process doesn't exist.'''
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stream:
+            return stream.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+
+
+class ProcessMonitor(object):
+    '''Reads the CPU time and resident memory of a process and its children
+    from /proc.'''
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks_per_second = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.last_cpu = self._cpu_seconds()
+        self.last_time = time.time()
+
+    def _pids(self):
+        pids = [self.pid]
+        try:
+            for name in os.listdir('/proc'):
+                if name.isdigit():
+                    fields = read_stat(name)
+                    # The parent pid is the 4th field of the full line.
+                    if fields is not None and int(fields[1]) == self.pid:
+                        pids.append(int(name))
+        except OSError:
+            pass
+        return pids
+
+    def _cpu_seconds(self):
+        total = None
+        for pid in self._pids():
+            fields = read_stat(pid)
+            if fields is None:
+                continue
+            # utime and stime are the 14th and 15th fields of the full line.
+            total = (total or 0) + (int(fields[11]) + int(fields[12])) / self.ticks_per_second
+        return total
+
+    def memory_mb(self):
+        total = None
+        for pid in self._pids():
+            try:
+                with open('/proc/{0}/status'.format(pid)) as stream:
+                    for line in stream:
+                        if line.startswith('VmRSS:'):
+                            total = (total or 0) + int(line.split()[1]) / 1024
+            except IOError:
+                pass
+        return total
+
+    def cpu_percent(self):
+        '''Returns the CPU use since the last call, as a percentage of one
+        core.'''
+        cpu, now = self._cpu_seconds(), time.time()
+        if cpu is None or self.last_cpu is None:
+            return None
+        percent = (cpu - self.last_cpu) / (now - self.last_time) * 100
+        self.last_cpu, self.last_time = cpu, now
+        return percent
+
+
+def run_clients(clients, port, frame_interval, duration, queue):
+    '''Runs the given (number, kind) clients for `duration` seconds,
+    putting batches of results on `queue`, followed by `None` when done.
+    Used as the target of each client process.'''
+    results = Results()
+    stop_flag = threading.Event()
+    threads = [
+        Client(number, kind, port, frame_interval, results, stop_flag)
+        for number, kind in clients]
+    for thread in threads:
+        thread.start()
+
+    end = time.time() + duration
+    while time.time() < end:
+        time.sleep(min(BATCH_INTERVAL, max(0, end - time.time())))
+        queue.put(results.take_interval())
+
+    stop_flag.set()
+    for thread in threads:
+        thread.join(10)
+    queue.put(results.take_interval())
+    queue.put(None)
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection('localhost', port, timeout=1)
+            connection.request('GET', '/heartbeat')
+            if connection.getresponse().read().decode() == 'ok':
+                return
+        except (httplib.HTTPException, socket.error):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('Server did not start within {0} seconds'.format(timeout))
+
+
+def format_value(value, unit=''):
+    return 'n/a' if value is None else '{0:.1f}{1}'.format(value, unit)
+
+
+def format_line(label, summary, cpu, memory):
+    return '{0:>8} {1:>9} req/s  p50 {2:>8}  p99 {3:>8}  errors {4:>6}  cpu {5:>7}  mem {6:>9}'.format(
+        label,
+        format_value(summary['requests_per_second']),
+        format_value(summary['p50_ms'], 'ms'),
+        format_value(summary['p99_ms'], 'ms'),
+        '{0:.2%}'.format(summary['error_rate']),
+        format_value(cpu, '%'),
+        format_value(memory, 'MB'))
+
+
+def run(clients, duration, mix, frame_interval, port, num_players, output=None,
+        client_processes=None, server_target=run_server, server_args=()):
+    '''Runs a load test and returns the summary of the whole run. The
+    server process is started with `server_target(port, num_players,
+    *server_args)`, and the clients are split between `client_processes`
+    processes (by default, one per CPU).'''
+    if client_processes is None:
+        client_processes = multiprocessing.cpu_count()
+    client_processes = max(1, min(client_processes, clients))
+
+    # Not a daemon, so that it can start worker processes of its own.
+    process = multiprocessing.Process(
+        target=server_target, args=(port, num_players) + tuple(server_args))
+    process.start()
+    workers = []
+    try:
+        wait_for_server(port)
+        monitor = ProcessMonitor(process.pid)
+        results = Results()
+        queue = multiprocessing.Queue()
+        kinds = assign_kinds(parse_mix(mix), clients)
+        numbered = list(enumerate(kinds))
+        for index in range(client_processes):
+            worker = multiprocessing.Process(
+                target=run_clients,
+                args=(numbered[index::client_processes], port, frame_interval,
+                      duration, queue))
+            worker.daemon = True
+            workers.append(worker)
+
+        print('Running {0} clients in {1} processes for {2} seconds: {3}'.format(
+            clients, client_processes, duration, ', '.join(
+                '{0} {1}'.format(kinds.count(kind), kind) for kind in sorted(set(kinds)))))
+        start = last = time.time()
+        for worker in workers:
+            worker.start()
+
+        samples = []
+        running = len(workers)
+        while running:
+            batch = queue.get()
+            if batch is None:
+                running -= 1
+            else:
+                results.merge(batch)
+            now = time.time()
+            if now - last < REPORT_INTERVAL:
+                # Results left over once every client has stopped are only
+                # reported in the total.
+                continue
+            summary = summarize(results.take_interval(), now - last)
+            summary['cpu_percent'] = monitor.cpu_percent()
+            summary['memory_mb'] = monitor.memory_mb()
+            summary['elapsed'] = now - start
+            samples.append(summary)
+            print(format_line(
+                '{0:.0f}s'.format(now - start), summary,
+                summary['cpu_percent'], summary['memory_mb']))
+            last = now
+
+        elapsed = time.time() - start
+    finally:
+        for worker in workers:
+            worker.terminate()
+        process.terminate()
+
+    total = summarize(results.total, elapsed)
+    cpus = [sample['cpu_percent'] for sample in samples if sample['cpu_percent'] is not None]
+    memories = [sample['memory_mb'] for sample in samples if sample['memory_mb'] is not None]
+    total['cpu_percent'] = sum(cpus) / len(cpus) if cpus else None
+    total['memory_mb'] = max(memories) if memories else None
+    total['clients'] = clients
+    total['mix'] = mix
+    total['duration'] = elapsed
+    total['samples'] = samples
+
+    print(format_line('total', total, total['cpu_percent'], total['memory_mb']))
+    for kind, summary in sorted(total['kinds'].items()):
+        print(format_line(kind, summary, None, None))
+
+    if output is not None:
+        with open(output, 'w') as stream:
+            json.dump(total, stream, indent=2, sort_keys=True)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load and soak test the Kinect server with simulated Snap clients.')
+    parser.add_argument('--clients', type=int, default=30,
+                        help='number of simulated browsers (default: 30)')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds to run for (default: 60)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='proportion of each kind of client (default: %(default)s)')
+    parser.add_argument('--frame-interval', type=float, default=1 / 30,
+                        help='seconds between frames for each client; 0 sends '
+                             'requests as fast as possible (default: 1/30)')
+    parser.add_argument('--players', type=int, default=2,
+                        help='number of synthetic players in view (default: 2)')
+    parser.add_argument('--client-processes', type=int,
+                        help='number of processes to run the clients in '
+                             '(default: one per CPU)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server worker processes (default: 1)')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='port to run the server on (default: %(default)s)')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    args = parser.parse_args()
+
+    server_target, server_args = run_server, ()
+    if args.workers > 1:
+        server_target, server_args = run_pooled_server, (args.workers,)
+    run(args.clients, args.duration, args.mix, args.frame_interval, args.port,
+        args.players, args.output, args.client_processes, server_target, server_args)
+
+if __name__ == '__main__':
+    main()
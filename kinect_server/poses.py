@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Provides a library of named reference poses, and finds which saved pose each
+tracked player is closest to on every frame.
+
+Poses are compared using the x and y coordinates of every joint, relative to
+the `hipcenter` joint and divided by the length of the torso (`hipcenter` to
+`shouldercenter`), so a pose matches regardless of where the player stands
+or how tall they are. Distances are the root-mean-square distance per joint,
+in torso lengths.
+"""
+
+from __future__ import print_function, division
+
+import os
+import threading
+
+import numpy
+
+import kinect
+
+POSES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poses.npz')
+
+POSE_JOINTS = sorted(kinect.JOINTS)
+ORIGIN = POSE_JOINTS.index('hipcenter')
+TORSO = POSE_JOINTS.index('shouldercenter')
+
+
+def normalize_pose(skeleton):
+    '''Converts a skeleton (as stored in `KinectData.data['skeletons']`) into
+    a flat array of normalized joint coordinates, or returns `None` if the
+    skeleton has no torso (for example, because it isn't tracked).'''
+    points = numpy.array(
+        [(skeleton[name]['x'], skeleton[name]['y']) for name in POSE_JOINTS],
+        dtype=numpy.float64)
+    points -= points[ORIGIN]
+    scale = numpy.hypot(points[TORSO, 0], points[TORSO, 1])
+    if scale == 0:
+        return None
+    return (points / scale).ravel()
+
+
+def normalize_poses(points):
+    '''Normalizes many frames at once, like `normalize_pose`. Accepts an
+    array of x and y coordinates with shape (frames, len(POSE_JOINTS), 2),
+    and returns an array with a row of normalized coordinates per frame.
+    Rows for frames with no torso are NaN.'''
+    points = points - points[:, ORIGIN:ORIGIN + 1]
+    scale = numpy.hypot(points[:, TORSO, 0], points[:, TORSO, 1])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        normalized = points.reshape(len(points), -1) / scale[:, None]
+    normalized[scale == 0] = numpy.nan
+    return normalized
+
+
+class PoseLibrary(object):
+    '''Holds the saved poses, and persists them to `path` (a numpy `.npz`
+    file) whenever they change. Pass the `update` method to
+    `KinectData.add_listener` to match every tracked player against the
+    library on every frame.'''
+    def __init__(self, path=POSES_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # The names and the matching rows of normalized coordinates are
+        # replaced together, so the Kinect thread can read them without
+        # taking the lock.
+        self.library = ([], numpy.zeros((0, len(POSE_JOINTS) * 2)))
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        '''Replaces the poses in memory with the ones saved in the file.'''
+        with numpy.load(self.path) as saved:
+            self.library = ([str(name) for name in saved['names']], saved['poses'])
+
+    def _save(self):
+        if self.path is None:
+            return
+        names, poses = self.library
+        with open(self.path, 'wb') as stream:
+            numpy.savez(stream, names=numpy.array(names, dtype=str), poses=poses)
+
+    def get_names(self):
+        '''Returns the names of every saved pose.'''
+        return list(self.library[0])
+
+    def add(self, name, skeleton):
+        '''Saves the skeleton's current pose under the given name, replacing
+        any pose with the same name. Raises `ValueError` if the skeleton
+        isn't tracked.'''
+        pose = normalize_pose(skeleton)
+        if pose is None:
+            raise ValueError('Cannot save a pose from an untracked skeleton')
+        with self.lock:
+            names, poses = self.library
+            if name in names:
+                poses = poses.copy()
+                poses[names.index(name)] = pose
+            else:
+                names = names + [name]
+                poses = numpy.vstack([poses, pose])
+            self.library = (names, poses)
+            self._save()
+
+    def remove(self, name):
+        '''Deletes the pose with the given name. Raises `KeyError` if there
+        is no such pose.'''
+        with self.lock:
+            names, poses = self.library
+            if name not in names:
+                raise KeyError(name)
+            index = names.index(name)
+            self.library = (
+                names[:index] + names[index + 1:],
+                numpy.delete(poses, index, axis=0))
+            self._save()
+
+    def match(self, skeleton):
+        '''Returns the name of the saved pose closest to the skeleton and
+        its distance, or `None` if the skeleton isn't tracked or there are
+        no saved poses.'''
+        names, poses = self.library
+        pose = normalize_pose(skeleton)
+        if pose is None or not names:
+            return None
+        difference = poses - pose
+        squared = numpy.einsum('ij,ij->i', difference, difference)
+        index = int(numpy.argmin(squared))
+        return names[index], float(numpy.sqrt(squared[index] / len(POSE_JOINTS)))
+
+    def match_all(self, normalized):
+        '''Matches many frames at once, given the output of
+        `normalize_poses`. Returns the saved pose names, the index of the
+        closest pose for each frame, and the distance to it. Frames without a
+        torso have an index of -1 and a distance of NaN.'''
+        names, poses = self.library
+        frames = len(normalized)
+        if not names:
+            return names, numpy.full(frames, -1), numpy.full(frames, numpy.nan)
+        # Expands |a - b|^2, so the frames are compared with every pose in a
+        # single matrix product instead of a frames x poses x joints array.
+        squared = (
+            numpy.einsum('ij,ij->i', normalized, normalized)[:, None] -
+            2 * normalized.dot(poses.T) +
+            numpy.einsum('ij,ij->i', poses, poses)[None, :])
+        missing = numpy.isnan(normalized).any(axis=1)
+        squared[missing] = 0
+        indices = numpy.argmin(squared, axis=1)
+        distances = numpy.sqrt(
+            numpy.maximum(squared[numpy.arange(frames), indices], 0) / len(POSE_JOINTS))
+        indices[missing] = -1
+        distances[missing] = numpy.nan
+        return names, indices, distances
+
+    def update(self, data):
+        '''Stores the closest pose for every player in `data['poses']`.'''
+        results = {}
+        for player, skeleton in data['skeletons'].items():
+            match = None
+            if player in data['tracked_players']:
+                match = self.match(skeleton)
+            if match is None:
+                results[player] = {'name': '', 'distance': 0}
+            else:
+                results[player] = {'name': match[0], 'distance': match[1]}
+        data['poses'] = results
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Predicts where each joint will be a short time from now, to hide the lag
+between a player moving and a Snap sprite following them.
+
+Once per frame, from the Kinect thread, an alpha-beta filter (a
+constant-velocity model with fixed gains, the steady state of a Kalman
+filter) smooths every joint's position and estimates its velocity. Requests
+with `?predict=<ms>` then extrapolate each coordinate as
+
+    position + velocity * (time since the frame + ms / 1000)
+
+which is one multiply-add per value.
+
+To check how well this works, run `python prediction.py`, which compares the
+prediction error against doing nothing on synthetic motion from
+`fake_kinect`, or `python prediction.py --session <directory>` for a session
+recorded and converted with `sessions.py`.
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import time
+
+import numpy
+
+import bones
+
+# Gains of the filter. Higher values follow new measurements more closely;
+# lower values smooth out more of the sensor's jitter. Chosen by running
+# `python prediction.py` with a range of jitter.
+ALPHA = 0.5
+BETA = 0.1
+
+# The filter starts again for a player after a gap this long (in seconds).
+MAX_FRAME_GAP = 0.5
+
+# The furthest ahead a request can ask to predict, in milliseconds.
+MAX_PREDICTION = 500
+
+COORDS = 'xyz'
+
+
+class MotionFilter(object):
+    '''Smooths an array of positions and estimates their velocity, one
+    frame at a time.'''
+    def __init__(self, alpha=ALPHA, beta=BETA):
+        self.alpha = alpha
+        self.beta = beta
+        self.time = None
+        self.position = None
+        self.velocity = None
+
+    def update(self, now, measured):
+        '''Adds the positions measured at time `now` (in seconds).'''
+        elapsed = None if self.time is None else now - self.time
+        if elapsed is None or not 0 < elapsed <= MAX_FRAME_GAP:
+            self.position = numpy.array(measured, dtype=float)
+            self.velocity = numpy.zeros_like(self.position)
+        else:
+            predicted = self.position + self.velocity * elapsed
+            residual = measured - predicted
+            self.position = predicted + self.alpha * residual
+            self.velocity = self.velocity + (self.beta / elapsed) * residual
+        self.time = now
+
+    def predict(self, now):
+        '''Returns the predicted positions at time `now`.'''
+        return self.position + self.velocity * (now - self.time)
+
+
+def to_joints(array):
+    return dict(
+        (joint, dict(zip(COORDS, row)))
+        for joint, row in zip(bones.JOINT_NAMES, array.tolist()))
+
+
+class Predictor(object):
+    '''Keeps a `MotionFilter` for every tracked player. Pass the `update`
+    method to `KinectData.add_listener`.'''
+    def __init__(self, alpha=ALPHA, beta=BETA):
+        self.alpha = alpha
+        self.beta = beta
+        self.filters = {}
+
+    def update(self, data):
+        '''Stores the smoothed positions and velocities of every tracked
+        player's joints in `data['motion']`, along with the time they were
+        measured.'''
+        now = time.time()
+        motion = {}
+        for player in data['tracked_players']:
+            skeleton = data['skeletons'][player]
+            measured = numpy.array([
+                [skeleton[joint][coord] for coord in COORDS]
+                for joint in bones.JOINT_NAMES], dtype=float)
+            motion_filter = self.filters.get(player)
+            if motion_filter is None:
+                motion_filter = self.filters[player] = MotionFilter(self.alpha, self.beta)
+            motion_filter.update(now, measured)
+            motion[player] = {
+                'time': now,
+                'positions': to_joints(motion_filter.position),
+                'velocities': to_joints(motion_filter.velocity)
+            }
+        for player in list(self.filters):
+            if player not in motion:
+                del self.filters[player]
+        data['motion'] = motion
+
+
+def rmse(errors):
+    return float(numpy.sqrt(numpy.nanmean(errors ** 2)))
+
+
+def evaluate(times, measured, targets, lead, alpha=ALPHA, beta=BETA):
+    '''Replays frames measured at `times` (an array of shape (frames,
+    joints, 3), NaN where the player isn't tracked) through a
+    `MotionFilter`. Returns the root-mean-square error of predicting the
+    positions `lead` seconds after each frame, compared with `targets`,
+    both for the filter's prediction and for just using the last frame.'''
+    motion_filter = MotionFilter(alpha, beta)
+    predicted = numpy.full(measured.shape, numpy.nan)
+    for index, now in enumerate(times):
+        if numpy.isnan(measured[index]).any():
+            motion_filter.time = None
+            continue
+        motion_filter.update(now, measured[index])
+        predicted[index] = motion_filter.predict(now + lead)
+    return {
+        'lead_ms': lead * 1000,
+        'last_frame_rmse': rmse(measured - targets),
+        'predicted_rmse': rmse(predicted - targets)
+    }
+
+
+def synthetic_motion(seconds, jitter, seed=0):
+    '''Returns frame times, noisy measured positions and a function giving
+    the true positions at any time, for the synthetic player from
+    `fake_kinect`. `jitter` is the standard deviation of the noise added to
+    each coordinate.'''
+    import fake_kinect
+    import kinect
+
+    def truth(t):
+        positions = fake_kinect.make_skeleton_positions(t)
+        joints = dict((name, kinect.normalize(positions[joint_id]))
+                      for name, joint_id in kinect.JOINTS.items())
+        return numpy.array([[joints[joint][coord] for coord in COORDS]
+                            for joint in bones.JOINT_NAMES])
+
+    rng = numpy.random.RandomState(seed)
+    frames = int(seconds * fake_kinect.FRAME_RATE)
+    times = (numpy.arange(frames) / fake_kinect.FRAME_RATE +
+             rng.normal(0, 0.002, frames))
+    measured = numpy.array([truth(t) for t in times])
+    measured += rng.normal(0, jitter, measured.shape)
+    return times, measured, truth
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how well joint prediction hides lag.')
+    parser.add_argument('--session', help='directory of a converted session '
+                        '(default: synthetic motion)')
+    parser.add_argument('--player', type=int, default=1,
+                        help='player to use from the session (default: 1)')
+    parser.add_argument('--seconds', type=float, default=60,
+                        help='seconds of synthetic motion (default: 60)')
+    parser.add_argument('--jitter', type=float, default=2.0,
+                        help='noise added to synthetic motion (default: 2)')
+    parser.add_argument('--lead', type=float, nargs='+', default=[33, 66, 100, 150],
+                        help='milliseconds ahead to predict (default: 33 66 100 150)')
+    parser.add_argument('--alpha', type=float, default=ALPHA)
+    parser.add_argument('--beta', type=float, default=BETA)
+    args = parser.parse_args()
+
+    if args.session is None:
+        times, measured, truth = synthetic_motion(args.seconds, args.jitter)
+
+        def targets(lead):
+            return numpy.array([truth(t + lead) for t in times])
+    else:
+        import sessions
+
+        session = sessions.Session(args.session)
+        times = numpy.asarray(session.get_times())
+        measured = session.get_positions(args.player, bones.JOINT_NAMES, COORDS)
+        measured[~session.get_tracked(args.player)] = numpy.nan
+
+        def targets(lead):
+            # The recording is the best guess of where the joints really
+            # were, so compare with it, interpolated between frames.
+            result = numpy.empty_like(measured)
+            for joint in range(measured.shape[1]):
+                for coord in range(measured.shape[2]):
+                    result[:, joint, coord] = numpy.interp(
+                        times + lead, times, measured[:, joint, coord],
+                        right=numpy.nan)
+            return result
+
+    print('{0:>8} {1:>16} {2:>16} {3:>9}'.format(
+        'lead', 'last frame rmse', 'predicted rmse', 'change'))
+    for lead in args.lead:
+        result = evaluate(
+            times, measured, targets(lead / 1000), lead / 1000, args.alpha, args.beta)
+        print('{0:>6.0f}ms {1:>16.2f} {2:>16.2f} {3:>8.0%}'.format(
+            result['lead_ms'], result['last_frame_rmse'], result['predicted_rmse'],
+            result['predicted_rmse'] / result['last_frame_rmse'] - 1))
+
+if __name__ == '__main__':
+    main()
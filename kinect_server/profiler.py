@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Provides an on-demand sampling profiler for the running server.
+
+While profiling, a background thread periodically captures the stack of
+every thread. Frames are processed on the thread the Kinect runtime delivers
+them on (the `display` callback in `kinect.py`, which normalizes the joints
+and runs the listeners), and requests on the main thread, where the gevent
+hub runs every request greenlet. The other threads, such as `KinectProcess`
+and the supervisor, spend nearly all their time waiting.
+
+Stacks whose innermost frame is waiting (see IDLE_FRAMES) are left out, so
+that the work stands out. The rest are counted and returned in the
+"collapsed" format used by flamegraph tools, one stack per line:
+
+    MainThread;serve_forever (pywsgi.py:150);...;convert_skeleton (server.py:58) 41
+
+Nothing runs until a profile is requested, so the profiler costs nothing
+while idle.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.005
+MAX_SECONDS = 60
+
+# Innermost frames of a thread which is waiting rather than working, as
+# (function, file) pairs. Threads sleeping with `time.sleep` can't be told
+# apart from working ones, so the server's own threads wait on events.
+IDLE_FRAMES = set([
+    # Events, conditions and queues.
+    ('wait', 'threading.py'),
+    # The gevent hub waiting for network events.
+    ('run', 'hub.py'),
+    # gevent's thread pool waiting for work.
+    ('acquire_with_timeout', '_threading.py'),
+])
+
+
+class ProfilerBusy(Exception):
+    '''Raised when a profile is requested while another is running.'''
+    pass
+
+
+def describe_frame(frame):
+    code = frame.f_code
+    return '{0} ({1}:{2})'.format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def is_idle(frame):
+    '''Returns whether `frame`, the innermost frame of a thread, is
+    waiting.'''
+    code = frame.f_code
+    return (code.co_name, os.path.basename(code.co_filename)) in IDLE_FRAMES
+
+
+def collapse_stack(thread_name, frame):
+    '''Returns the stack ending at `frame` as a semicolon-separated string,
+    outermost call first.'''
+    names = []
+    while frame is not None:
+        names.append(describe_frame(frame))
+        frame = frame.f_back
+    names.append(thread_name)
+    names.reverse()
+    return ';'.join(names)
+
+
+class Profile(threading.Thread):
+    '''Samples the stacks of every other thread for `seconds` seconds. Once
+    the thread has finished, the collapsed stacks are available from the
+    `result` attribute. Idle stacks are left out unless `include_idle` is
+    true.'''
+    def __init__(self, seconds, interval, on_finish, include_idle=False):
+        super(Profile, self).__init__(name='SamplingProfiler')
+        self.daemon = True
+        self.seconds = seconds
+        self.interval = interval
+        self.on_finish = on_finish
+        self.include_idle = include_idle
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = self._sample()
+        finally:
+            self.on_finish()
+
+    def _sample(self):
+        counts = {}
+        end = time.time() + self.seconds
+        while time.time() < end:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident or (not self.include_idle and is_idle(frame)):
+                    continue
+                name = names.get(ident, 'Thread-{0}'.format(ident))
+                stack = collapse_stack(name, frame)
+                counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(self.interval)
+        return '\n'.join(
+            '{0} {1}'.format(stack, count)
+            for stack, count in sorted(counts.items()))
+
+
+class SamplingProfiler(object):
+    '''Starts profiles, making sure only one runs at a time.'''
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def start(self, seconds, include_idle=False):
+        '''Starts a `Profile` lasting `seconds` seconds (at most
+        MAX_SECONDS), and returns it. Raises `ProfilerBusy` if a profile is
+        already running.'''
+        if not self.lock.acquire(False):
+            raise ProfilerBusy('A profile is already running')
+        profile = Profile(
+            min(seconds, MAX_SECONDS), self.interval, self.lock.release, include_idle)
+        profile.start()
+        return profile
@@ -2,15 +2,40 @@
 '''Runs the webserver and serves the Kinect data from port 5000.'''
 
 from __future__ import print_function, division
+import atexit
+import copy
 import ctypes
+import socket
+import sys
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from gevent.wsgi import WSGIServer
+from gevent.pywsgi import WSGIServer
+import gevent
 
+import bones
+import dashboard
 import kinect
+import poses
+import prediction
+import profiler
+import sessions
+import workers
+import zones
 
 DEBUG = False
+PORT = 5000
+
+# Enables `/debug/profile`, which samples the server's stacks on demand.
+PROFILING = False
+
+# If set to a filename, every frame is appended to that file, to be analysed
+# later with sessions.py.
+RECORDING = None
+
+# Number of processes serving requests. With more than one, a single process
+# owns the Kinect and shares each frame with the others (see workers.py).
+WORKERS = 1
 
 ORDER = [
     'footleft',
@@ -59,6 +84,12 @@ def convert_multiple_skeletons(json):
     return convert_skeleton(json[1]) + '\n' + convert_skeleton(json[2])
 
 
+def convert_measurements(json, names):
+    '''Converts joint angles or bone lengths into RAW format (returns the
+    values in the order given by `names`, separated by newlines).'''
+    return '\n'.join(str(json[name]) for name in names)
+
+
 def should_use_json():
     '''Returns true if the requested response type is JSON.'''
     form = request.args.get('format')
@@ -80,17 +111,115 @@ def format_data(json, data_type):
             return str(json)
 
 
-def setup():
+def convert_zone_events(events):
+    '''Converts zone events into RAW format (returns the id, type, zone,
+    player, and joint of each event, one event per line).'''
+    return '\n'.join(
+        ' '.join(map(str, (event['id'], event['type'], event['zone'],
+                           event['player'], event['joint'])))
+        for event in events)
+
+
+def match_skeletons(kinect_data, *args):
+    '''Returns `kinect_data.match(*args)`, or the predicted positions if
+    the `predict` query parameter gives a number of milliseconds.'''
+    milliseconds = request.args.get('predict', type=float)
+    if milliseconds is None:
+        return kinect_data.match(*args)
+    return kinect_data.predict(milliseconds, *args)
+
+
+def get_zone_joints():
+    '''Returns the joints listed in the `joints` query parameter, or
+    `None` if it is missing.'''
+    joints = request.args.get('joints')
+    if not joints:
+        return None
+    return [joint.lower().replace('_', '').replace('-', '') for joint in joints.split(',')]
+
+
+def get_numbers(names):
+    '''Returns the query parameters with the given names as numbers.
+    Raises `ValueError` if any are missing or not numbers.'''
+    numbers = []
+    for name in names:
+        value = request.args.get(name, type=float)
+        if value is None:
+            raise ValueError('Expected a number for ' + name)
+        numbers.append(value)
+    return numbers
+
+
+def add_profiling_routes(app):
+    sampling_profiler = profiler.SamplingProfiler()
+
+    @app.route("/debug/profile")
+    def profile():
+        seconds = request.args.get('seconds', 10, type=float)
+        include_idle = request.args.get('idle', 0, type=int) != 0
+        try:
+            running = sampling_profiler.start(seconds, include_idle)
+        except profiler.ProfilerBusy as ex:
+            return str(ex), 409
+        # Yield to other greenlets while sampling, so the requests being
+        # profiled keep being served.
+        while running.is_alive():
+            gevent.sleep(0.1)
+        return running.result, 200, {'Content-Type': 'text/plain'}
+
+
+def create_kinect_data(runtime_factory=None):
+    '''Creates the Kinect wrapper, along with the pose library matched
+    and zones tested against each of its frames. To serve synthetic frames
+    instead of connecting to a Kinect, pass a `fake_kinect.FakeKinect` as
+    the `runtime_factory`.'''
+    kinect_data = kinect.KinectData(runtime_factory)
+    pose_library = poses.PoseLibrary()
+    kinect_data.add_listener(pose_library.update)
+    zone_set = zones.ZoneSet()
+    kinect_data.add_listener(zone_set.update)
+    kinect_data.add_listener(prediction.Predictor().update)
+    if RECORDING:
+        recorder = sessions.Recorder(RECORDING)
+        kinect_data.add_listener(recorder.update)
+        atexit.register(recorder.close)
+    return kinect_data, pose_library, zone_set
+
+
+def create_app(kinect_data, pose_library, zone_set, cache_responses=False):
+    '''Creates the app serving data from `kinect_data`. If
+    `cache_responses` is true, responses are reused until the next frame
+    arrives.'''
     app = Flask(__name__, static_url_path='/static')
     CORS(app)
-    kinect_data = kinect.KinectData()
+    operations_dashboard = dashboard.Dashboard(kinect_data)
+    operations_dashboard.install(app)
+    operations_dashboard.start()
+    if cache_responses:
+        workers.FrameCache(kinect_data, operations_dashboard).install(app)
+    if PROFILING:
+        add_profiling_routes(app)
+
+    @app.before_request
+    def refresh_data():
+        kinect_data.refresh()
+
+    @app.after_request
+    def add_frame_number(response):
+        response.headers['X-Kinect-Frame'] = str(kinect_data.get_frame_number())
+        return response
 
     @app.route("/")
     def index():
         if should_use_json():
-            return jsonify(kinect_data.data)
+            # The predictor's filter state is internal, so is left out.
+            data = dict(
+                (key, value) for key, value in kinect_data.data.items()
+                if key != 'motion')
+            data['skeletons'] = match_skeletons(kinect_data)
+            return jsonify(data)
         else:
-            return convert_multiple_skeletons(kinect_data.match())
+            return convert_multiple_skeletons(match_skeletons(kinect_data))
 
     @app.route("/demo")
     def demo():
@@ -98,20 +227,135 @@ def setup():
 
     @app.route("/skeletons")
     def skeletons():
-        return format_data(kinect_data.match(), 'multiple')
+        return format_data(match_skeletons(kinect_data), 'multiple')
         return jsonify(kinect_data.match())
 
     @app.route("/skeletons/<int:skeleton_number>")
     def skeleton(skeleton_number):
-        return format_data(kinect_data.match(skeleton_number), 'single')
+        return format_data(match_skeletons(kinect_data, skeleton_number), 'single')
 
     @app.route("/skeletons/<int:skeleton_number>/<joint>")
     def skeleton_joint(skeleton_number, joint):
-        return format_data(kinect_data.match(skeleton_number, joint), 'joint')
+        return format_data(match_skeletons(kinect_data, skeleton_number, joint), 'joint')
 
     @app.route("/skeletons/<int:skeleton_number>/<joint>/<coord>")
     def skeleton_joint_coord(skeleton_number, joint, coord):
-        return str(kinect_data.match(skeleton_number, joint, coord))
+        return str(match_skeletons(kinect_data, skeleton_number, joint, coord))
+
+    @app.route("/skeletons/<int:skeleton_number>/angles")
+    def skeleton_angles(skeleton_number):
+        angles = kinect_data.match_angle(skeleton_number)
+        if should_use_json():
+            return jsonify(angles)
+        else:
+            return convert_measurements(angles, bones.ANGLE_NAMES)
+
+    @app.route("/skeletons/<int:skeleton_number>/angles/<joint>")
+    def skeleton_angle(skeleton_number, joint):
+        return str(kinect_data.match_angle(skeleton_number, joint))
+
+    @app.route("/skeletons/<int:skeleton_number>/bones")
+    def skeleton_bones(skeleton_number):
+        lengths = kinect_data.match_bone(skeleton_number)
+        if should_use_json():
+            return jsonify(lengths)
+        else:
+            return convert_measurements(lengths, bones.BONE_NAMES)
+
+    @app.route("/skeletons/<int:skeleton_number>/bones/<joint>")
+    def skeleton_bone(skeleton_number, joint):
+        return str(kinect_data.match_bone(skeleton_number, joint))
+
+    @app.route("/skeletons/<int:skeleton_number>/pose")
+    def skeleton_pose(skeleton_number):
+        pose = kinect_data.get_pose(skeleton_number)
+        if should_use_json():
+            return jsonify(pose)
+        else:
+            return pose['name']
+
+    @app.route("/skeletons/<int:skeleton_number>/pose/distance")
+    def skeleton_pose_distance(skeleton_number):
+        return str(kinect_data.get_pose(skeleton_number)['distance'])
+
+    @app.route("/skeletons/<int:skeleton_number>/save_pose/<name>")
+    def save_pose(skeleton_number, name):
+        with kinect_data.lock:
+            skeleton = copy.deepcopy(kinect_data.match(skeleton_number))
+        try:
+            pose_library.add(name, skeleton)
+        except ValueError as ex:
+            return str(ex), 400
+        return "ok"
+
+    @app.route("/poses")
+    def pose_names():
+        if should_use_json():
+            return jsonify(pose_library.get_names())
+        else:
+            return '\n'.join(pose_library.get_names())
+
+    @app.route("/poses/<name>/delete")
+    def delete_pose(name):
+        try:
+            pose_library.remove(name)
+        except KeyError:
+            return "No pose named " + name, 404
+        return "ok"
+
+    @app.route("/zones")
+    def zone_names():
+        if should_use_json():
+            return jsonify(zone_set.get_definitions())
+        else:
+            return '\n'.join(sorted(zone_set.get_definitions()))
+
+    @app.route("/zones/<name>")
+    def zone(name):
+        if name not in zone_set.get_definitions():
+            return "No zone named " + name, 404
+        joints = kinect_data.get_zone(name)
+        if should_use_json():
+            return jsonify(joints)
+        else:
+            return str(len(joints))
+
+    @app.route("/zones/<name>/box")
+    def set_box_zone(name):
+        try:
+            zone = zones.make_box(
+                *get_numbers(['x1', 'y1', 'z1', 'x2', 'y2', 'z2']),
+                joints=get_zone_joints())
+        except ValueError as ex:
+            return str(ex), 400
+        zone_set.add(name, zone)
+        return "ok"
+
+    @app.route("/zones/<name>/sphere")
+    def set_sphere_zone(name):
+        try:
+            zone = zones.make_sphere(
+                *get_numbers(['x', 'y', 'z', 'radius']), joints=get_zone_joints())
+        except ValueError as ex:
+            return str(ex), 400
+        zone_set.add(name, zone)
+        return "ok"
+
+    @app.route("/zones/<name>/delete")
+    def delete_zone(name):
+        try:
+            zone_set.remove(name)
+        except KeyError:
+            return "No zone named " + name, 404
+        return "ok"
+
+    @app.route("/zone_events")
+    def zone_events():
+        events = kinect_data.get_zone_events(request.args.get('since', 0, type=int))
+        if should_use_json():
+            return jsonify(events)
+        else:
+            return convert_zone_events(events)
 
     @app.route("/num_tracked")
     def num_tracked():
@@ -126,13 +370,33 @@ def setup():
 
     @app.route("/heartbeat")
     def heartbeat():
-        return "ok"
+        health = kinect_data.health()
+        if should_use_json():
+            return jsonify(health)
+        else:
+            return health['status']
+
+    return app
+
+
+def setup(runtime_factory=None):
+    '''Creates the app and the Kinect wrapper it serves data from. See
+    `create_kinect_data` for `runtime_factory`.'''
+    kinect_data, pose_library, zone_set = create_kinect_data(runtime_factory)
+    return create_app(kinect_data, pose_library, zone_set), kinect_data
+
 
-    return app, kinect_data
+class NoDelayWSGIServer(WSGIServer):
+    '''Disables Nagle's algorithm on every connection. Otherwise, on
+    keep-alive connections, small responses are held back until the
+    client's delayed ACK arrives, adding about 40ms to every request.'''
+    def handle(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        WSGIServer.handle(self, sock, address)
 
 
-def run_production_webserver(app):
-    http_webserver = WSGIServer(('', 5000), app, log=None)
+def run_production_webserver(app, port=PORT):
+    http_webserver = NoDelayWSGIServer(('', port), app, log=None)
     http_webserver.serve_forever()
 
 
@@ -149,17 +413,33 @@ def run_webserver(app):
 
 def main():
     print("Setting up data...")
-    app, kinect_data = setup()
+    if WORKERS > 1 and not workers.can_share_sockets():
+        create_error_message_popup(
+            "WORKERS must be 1 with Python 2 on Windows.\n"
+            "\n"
+            "Please consult the README for more information.")
+        sys.exit(1)
+    if WORKERS > 1:
+        pool = workers.WorkerPool(WORKERS, PORT)
+        kinect_data = pool.kinect_data
+    else:
+        app, kinect_data = setup()
     try:
         print("Connecting to the Kinect...")
         kinect_data.start()
 
         print("Ready! Hit `Ctrl+c` to end.")
-        print("Go to `localhost:5000/demo` in your browser to test the skeleton.\n")
-        run_webserver(app)
+        print("Go to `localhost:5000/demo` in your browser to test the skeleton.")
+        print("Go to `localhost:5000/dashboard` to monitor the server.\n")
+        if WORKERS > 1:
+            pool.serve_forever()
+        else:
+            run_webserver(app)
     except KeyboardInterrupt:
         print("Closing Kinect connection...")
         kinect_data.end()
+        if WORKERS > 1:
+            pool.stop()
 
         print("Goodbye!")
     except WindowsError:
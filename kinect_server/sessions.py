@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+Records sessions from the Kinect, and analyses them offline.
+
+To record, set `RECORDING` at the top of `server.py` to a filename. Every
+frame is then appended to that file as a line of JSON, holding the time and
+the joints of each tracked player, in the same format as
+`localhost:5000/skeletons?format=json`.
+
+Recordings are slow to read back, so before analysing one, convert it into a
+session directory:
+
+    python sessions.py convert lesson.jsonl lesson
+
+A session directory holds one `.npy` file per column: `time.npy`, then
+`<player>_tracked.npy` and `<player>_<joint>_<coord>.npy` for every player,
+joint, and coordinate. The columns are memory-mapped when read, so only the
+columns an analysis uses are loaded, and hours of frames can be summarized
+in seconds. Coordinates of untracked players are NaN.
+
+The analyses print CSV by default, or JSON with `--format json`, and can be
+limited to a time window with `--start` and `--end` (in seconds from the
+start of the session):
+
+    python sessions.py ranges lesson --start 60 --end 120
+    python sessions.py reach lesson --format json --output reach.json
+    python sessions.py poses lesson --threshold 0.2
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+
+import bones
+import kinect
+import poses
+
+COORDS = 'xyzw'
+PLAYERS = kinect.get_player_ids(kinect.NUM_PLAYERS)
+
+# Number of recorded frames waiting to be written before new ones are
+# dropped, about 30 seconds' worth.
+RECORDING_BACKLOG = 1000
+
+# Number of frames converted at a time.
+CHUNK_FRAMES = 10000
+
+# Frames further apart than this (for example, because the Kinect
+# reconnected) don't count towards each other's duration.
+MAX_FRAME_GAP = 0.5
+
+# Joints measured from when finding how far a player reaches.
+REACH_ORIGIN = 'shouldercenter'
+REACH_JOINTS = ['handleft', 'handright']
+
+
+def column_name(player, joint, coord):
+    return '{0}_{1}_{2}'.format(player, joint, coord)
+
+
+def tracked_name(player):
+    return '{0}_tracked'.format(player)
+
+
+class Recorder(object):
+    '''Appends every frame to a file as a line of JSON. Pass the `update`
+    method to `KinectData.add_listener`, and call `close` when done.
+
+    Frames are written from a separate thread, so a slow disk doesn't hold
+    up the Kinect. If writing fails, recording stops and the error is
+    printed.'''
+    def __init__(self, path):
+        # Line buffered, so frames aren't lost if the server is killed.
+        self.stream = open(path, 'a', 1)
+        self.lines = queue.Queue(RECORDING_BACKLOG)
+        self.failed = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._write, name='Recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, data):
+        if self.failed:
+            return
+        line = json.dumps({
+            'time': time.time(),
+            'skeletons': dict(
+                (player, data['skeletons'][player])
+                for player in data['tracked_players'])
+        }) + '\n'
+        try:
+            self.lines.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                break
+            try:
+                self.stream.write(line)
+            except (IOError, OSError) as ex:
+                self.failed = True
+                print("Stopped recording: {0}".format(ex), file=sys.stderr)
+                break
+
+    def close(self):
+        '''Writes any waiting frames, then closes the file.'''
+        if self.thread.is_alive():
+            self.lines.put(None)
+            self.thread.join()
+        try:
+            self.stream.close()
+        except (IOError, OSError):
+            pass
+        if self.dropped:
+            print("Recording dropped {0} frames because the disk couldn't keep up".format(
+                self.dropped), file=sys.stderr)
+
+
+def convert(recording, directory):
+    '''Converts a recording into a session directory, and returns the
+    number of frames.'''
+    with open(recording) as stream:
+        frames = sum(1 for line in stream if line.strip())
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def create(name, dtype):
+        return numpy.lib.format.open_memmap(
+            os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype,
+            shape=(frames,))
+
+    times = create('time', numpy.float64)
+    tracked = dict((player, create(tracked_name(player), numpy.bool_)) for player in PLAYERS)
+    keys = [(player, joint, coord)
+            for player in PLAYERS for joint in bones.JOINT_NAMES for coord in COORDS]
+    columns = [create(column_name(*key), numpy.float32) for key in keys]
+    missing = dict((coord, float('nan')) for coord in COORDS)
+
+    def flush(start, rows):
+        block = numpy.array(rows, dtype=numpy.float64)
+        end = start + len(rows)
+        times[start:end] = block[:, 0]
+        for index, player in enumerate(PLAYERS):
+            tracked[player][start:end] = block[:, 1 + index] > 0
+        for index, column in enumerate(columns):
+            column[start:end] = block[:, 1 + len(PLAYERS) + index]
+        return end
+
+    start, rows = 0, []
+    with open(recording) as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            frame = json.loads(line)
+            skeletons = frame['skeletons']
+            row = [frame['time']]
+            row.extend(1 if str(player) in skeletons else 0 for player in PLAYERS)
+            for player in PLAYERS:
+                skeleton = skeletons.get(str(player))
+                for joint in bones.JOINT_NAMES:
+                    values = skeleton[joint] if skeleton is not None else missing
+                    row.extend(values[coord] for coord in COORDS)
+            rows.append(row)
+            if len(rows) == CHUNK_FRAMES:
+                start, rows = flush(start, rows), []
+    if rows:
+        flush(start, rows)
+
+    for array in [times] + list(tracked.values()) + columns:
+        array.flush()
+    return frames
+
+
+class Session(object):
+    '''A converted session, or a time window of one. Columns are read from
+    memory-mapped files, so creating a session and slicing it are cheap.'''
+    def __init__(self, directory, rows=None):
+        self.directory = directory
+        self.times = self._load('time')
+        self.rows = rows if rows is not None else slice(0, len(self.times))
+
+    def _load(self, name):
+        return numpy.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.rows.stop - self.rows.start
+
+    def window(self, start=None, end=None):
+        '''Returns the part of the session between `start` and `end`
+        seconds after it began. Either may be `None` to leave that end open.'''
+        times = self.get_times()
+        origin = self.times[0] if len(self.times) else 0
+        first = 0 if start is None else int(numpy.searchsorted(times, origin + start))
+        last = len(times) if end is None else int(numpy.searchsorted(times, origin + end))
+        return Session(self.directory, slice(
+            self.rows.start + first, self.rows.start + max(first, last)))
+
+    def get_times(self):
+        return self.times[self.rows]
+
+    def get_durations(self):
+        '''Returns how long each frame lasted, in seconds.'''
+        times = numpy.asarray(self.get_times())
+        if len(times) < 2:
+            return numpy.zeros(len(times))
+        durations = numpy.diff(times)
+        durations = numpy.append(durations, numpy.median(durations))
+        durations[durations > MAX_FRAME_GAP] = 0
+        return durations
+
+    def get_tracked(self, player):
+        return numpy.asarray(self._load(tracked_name(player))[self.rows])
+
+    def get_column(self, player, joint, coord):
+        return self._load(column_name(player, joint, coord))[self.rows]
+
+    def get_positions(self, player, joints, coords):
+        '''Returns an array with shape (frames, joints, coords).'''
+        return numpy.stack([
+            numpy.stack([self.get_column(player, joint, coord) for coord in coords], axis=-1)
+            for joint in joints], axis=1).astype(numpy.float64)
+
+
+def joint_ranges(session):
+    '''Returns the range of movement of every joint of every player along
+    each of x, y, and z, over the frames they were tracked.'''
+    results = []
+    for player in PLAYERS:
+        tracked = session.get_tracked(player)
+        frames = int(tracked.sum())
+        if not frames:
+            continue
+        positions = session.get_positions(player, bones.JOINT_NAMES, 'xyz')[tracked]
+        low, high = positions.min(axis=0), positions.max(axis=0)
+        mean, std = positions.mean(axis=0), positions.std(axis=0)
+        for j, joint in enumerate(bones.JOINT_NAMES):
+            for c, coord in enumerate('xyz'):
+                results.append({
+                    'player': player, 'joint': joint, 'coord': coord,
+                    'frames': frames, 'min': float(low[j, c]),
+                    'max': float(high[j, c]), 'range': float(high[j, c] - low[j, c]),
+                    'mean': float(mean[j, c]), 'std': float(std[j, c])})
+    return results
+
+
+def reach(session):
+    '''Returns how far each player reached with each hand, measured from
+    REACH_ORIGIN: furthest across the stage (in BYOB units, using x and y),
+    and furthest towards the Kinect (in millimeters).'''
+    results = []
+    for player in PLAYERS:
+        tracked = session.get_tracked(player)
+        if not tracked.any():
+            continue
+        positions = session.get_positions(
+            player, [REACH_ORIGIN] + REACH_JOINTS, 'xyz')[tracked]
+        offsets = positions[:, 1:] - positions[:, :1]
+        across = numpy.hypot(offsets[..., 0], offsets[..., 1]).max(axis=0)
+        forward = (-offsets[..., 2]).max(axis=0)
+        for index, joint in enumerate(REACH_JOINTS):
+            results.append({
+                'player': player, 'joint': joint,
+                'max_across': float(across[index]),
+                'max_forward_mm': float(forward[index])})
+    return results
+
+
+def time_in_poses(session, pose_library, threshold):
+    '''Returns how many frames and seconds each player spent in each saved
+    pose, counting frames whose closest pose is within `threshold`.'''
+    durations = session.get_durations()
+    results = []
+    for player in PLAYERS:
+        tracked = session.get_tracked(player)
+        normalized = poses.normalize_poses(
+            session.get_positions(player, poses.POSE_JOINTS, 'xy'))
+        names, indices, distances = pose_library.match_all(normalized)
+        matched = tracked & (indices >= 0) & (distances <= threshold)
+        counts = numpy.bincount(indices[matched], minlength=len(names))
+        seconds = numpy.bincount(
+            indices[matched], weights=durations[matched], minlength=len(names))
+        for index, name in enumerate(names):
+            results.append({
+                'player': player, 'pose': name,
+                'frames': int(counts[index]), 'seconds': float(seconds[index])})
+    return results
+
+
+def write_results(results, form, stream):
+    if form == 'json':
+        json.dump(results, stream, indent=2, sort_keys=True)
+        stream.write('\n')
+    elif results:
+        writer = csv.DictWriter(stream, fieldnames=list(results[0]), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert and analyse recorded Kinect sessions.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    converting = commands.add_parser(
+        'convert', help='convert a recording into a session directory')
+    converting.add_argument('recording')
+    converting.add_argument('directory')
+
+    analyses = {}
+    for name, description in [
+            ('ranges', 'range of movement of every joint'),
+            ('reach', 'how far each hand reached'),
+            ('poses', 'time spent in each saved pose')]:
+        analysis = commands.add_parser(name, help=description)
+        analysis.add_argument('directory')
+        analysis.add_argument('--start', type=float,
+                              help='seconds into the session to start from')
+        analysis.add_argument('--end', type=float,
+                              help='seconds into the session to stop at')
+        analysis.add_argument('--format', choices=['csv', 'json'], default='csv')
+        analysis.add_argument('--output', help='file to write to (default: print)')
+        analyses[name] = analysis
+    analyses['poses'].add_argument(
+        '--threshold', type=float, default=0.2,
+        help='furthest distance from a pose which counts as in it (default: 0.2)')
+    analyses['poses'].add_argument(
+        '--library', default=poses.POSES_FILE,
+        help='saved poses to match against (default: the server\'s)')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        start = time.time()
+        frames = convert(args.recording, args.directory)
+        print('Converted {0} frames in {1:.1f} seconds'.format(frames, time.time() - start))
+        return
+
+    session = Session(args.directory).window(args.start, args.end)
+    if args.command == 'ranges':
+        results = joint_ranges(session)
+    elif args.command == 'reach':
+        results = reach(session)
+    else:
+        results = time_in_poses(session, poses.PoseLibrary(args.library), args.threshold)
+
+    if args.output is None:
+        write_results(results, args.format, sys.stdout)
+    else:
+        with open(args.output, 'w') as stream:
+            write_results(results, args.format, stream)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Serves the Kinect data from several worker processes, so request handling is
+not limited to a single core.
+
+A single process owns the Kinect. After every frame it pickles the data
+dictionary, together with the connection health and frame statistics, into a
+block of shared memory guarded by a sequence lock. The worker processes all
+accept connections on the same listening socket, and before each request
+read the latest snapshot if a new one has been published. Since every
+worker reads the one snapshot the owner wrote, they all serve the same
+sequence of frames; the frame number is sent in the `X-Kinect-Frame` header.
+
+Each worker reuses its responses until the next snapshot is published (see
+`FrameCache`). Requests which change state, such as saving a pose or adding
+a zone, are validated by the worker and then sent to the owner over a queue,
+so they take effect in the next snapshot.
+
+The owner publishes a snapshot at least every PUBLISH_INTERVAL seconds, even
+when no frames arrive. If a worker stops receiving them, the owner has died:
+the worker reports `reconnecting` from `/heartbeat`, and exits soon after so
+that it stops holding the port.
+
+The dashboard and profiler run in every worker, and only see the requests
+handled by that worker.
+"""
+
+from __future__ import print_function, division
+
+import ctypes
+import multiprocessing
+# Lets sockets be passed to worker processes on Windows.
+import multiprocessing.reduction
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from flask import request
+import gevent
+
+import kinect
+import poses
+
+# Size of the shared snapshot buffer. A snapshot of two players, with every
+# listener's results, takes about 20KB.
+BUFFER_SIZE = 1 << 20
+
+# How often the owner publishes a snapshot when no frames are arriving, so
+# that the workers see the connection health change and know it is running.
+PUBLISH_INTERVAL = 0.25
+
+# How often each worker checks that the owner is still running.
+PARENT_CHECK_INTERVAL = 1.0
+
+# Seconds without a snapshot after which a worker reports that it has lost
+# the owner, and after which it exits. The parent process id can't be used to
+# notice the owner dying, since it doesn't change on Windows.
+OWNER_TIMEOUT = 8 * PUBLISH_INTERVAL
+OWNER_EXIT_TIMEOUT = 40 * PUBLISH_INTERVAL
+
+# Paths whose responses depend only on the current frame.
+CACHEABLE_PREFIXES = (
+    '/skeletons', '/num_tracked', '/tracked_players', '/zones/', '/zone_events')
+UNCACHEABLE_PARTS = ('/save_pose/',)
+UNCACHEABLE_SUFFIXES = ('/box', '/sphere', '/delete')
+
+
+def can_share_sockets():
+    '''Returns whether the listening socket can be passed to worker
+    processes. Python 2 on Windows rebuilds passed sockets with
+    `socket.fromfd`, which doesn't exist there; Python 3 uses `socket.share`
+    instead.'''
+    return sys.platform != 'win32' or hasattr(socket.socket, 'share')
+
+
+class SharedFrame(object):
+    '''A block of shared memory holding the latest snapshot, written by one
+    process and read by many. The sequence number is odd while a snapshot is
+    being written, so readers can tell when they need to retry.'''
+    def __init__(self, size=BUFFER_SIZE):
+        self.sequence = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.length = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.buffer = multiprocessing.RawArray(ctypes.c_char, size)
+        self.size = size
+
+    def publish(self, snapshot):
+        '''Pickles and publishes `snapshot`. Only one thread may publish at a
+        time. Raises `ValueError` if the snapshot doesn't fit.'''
+        payload = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.size:
+            raise ValueError('Snapshot of {0} bytes does not fit in the {1} byte buffer'.format(
+                len(payload), self.size))
+        self.sequence.value += 1
+        self.length.value = len(payload)
+        ctypes.memmove(self.buffer, payload, len(payload))
+        self.sequence.value += 1
+
+    def read(self, last_sequence=None):
+        '''Returns the latest snapshot and its sequence number, or `None` and
+        `last_sequence` if nothing newer than `last_sequence` has been
+        published.'''
+        while True:
+            sequence = self.sequence.value
+            if sequence == last_sequence or sequence == 0:
+                return None, last_sequence
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            payload = ctypes.string_at(self.buffer, self.length.value)
+            if self.sequence.value == sequence:
+                return pickle.loads(payload), sequence
+
+
+def take_snapshot(kinect_data, pose_library, zone_set):
+    '''Returns everything the workers need to answer requests. Must be
+    called with the Kinect data lock held.'''
+    health = kinect_data.health()
+    stats = kinect_data.stats
+    return {
+        'data': kinect_data.data,
+        'health': {
+            'status': health['status'],
+            'restarts': health['restarts'],
+            'last_error': health['last_error']
+        },
+        'stats': {
+            'frame_count': stats.frame_count,
+            'callback_time': stats.callback_time,
+            'last_frame_time': stats.last_frame_time,
+            'started_time': stats.started_time
+        },
+        'pose_names': pose_library.get_names(),
+        'zones': zone_set.get_definitions()
+    }
+
+
+class SharedKinectData(kinect.KinectData):
+    '''Serves the snapshots published to a `SharedFrame`, in place of a
+    connection to the Kinect. Call `refresh` to pick up the latest one.'''
+    def __init__(self, shared):
+        self.shared = shared
+        self.sequence = None
+        self.lock = threading.Lock()
+        self.stats = kinect.FrameStats()
+        self.health_fields = {'status': 'starting', 'restarts': 0, 'last_error': None}
+        self.pose_names = []
+        self.zone_definitions = {}
+        self.data = {}
+        self.snapshot_time = time.time()
+        self.refresh()
+        while not self.data:
+            time.sleep(0.01)
+            self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            snapshot, self.sequence = self.shared.read(self.sequence)
+            if snapshot is None:
+                return
+            self.snapshot_time = time.time()
+            self.data = snapshot['data']
+            self.health_fields = snapshot['health']
+            self.pose_names = snapshot['pose_names']
+            self.zone_definitions = snapshot['zones']
+            for name, value in snapshot['stats'].items():
+                setattr(self.stats, name, value)
+
+    def start(self):
+        pass
+
+    def end(self):
+        pass
+
+    def seconds_since_snapshot(self):
+        return time.time() - self.snapshot_time
+
+    def health(self):
+        health = dict(self.health_fields)
+        if self.seconds_since_snapshot() > OWNER_TIMEOUT:
+            health['status'] = 'reconnecting'
+            health['last_error'] = 'Lost contact with the process owning the Kinect'
+        health['seconds_since_frame'] = self.stats.seconds_since_frame()
+        health['frame_count'] = self.stats.frame_count
+        return health
+
+
+class RemotePoseLibrary(object):
+    '''Stands in for the owner's `PoseLibrary` in a worker. Changes are
+    checked here, so errors can be reported straight away, and then sent to
+    the owner to apply.'''
+    def __init__(self, kinect_data, commands):
+        self.kinect_data = kinect_data
+        self.commands = commands
+
+    def get_names(self):
+        return list(self.kinect_data.pose_names)
+
+    def add(self, name, skeleton):
+        if poses.normalize_pose(skeleton) is None:
+            raise ValueError('Cannot save a pose from an untracked skeleton')
+        self.commands.put(('poses', 'add', (name, skeleton)))
+
+    def remove(self, name):
+        if name not in self.kinect_data.pose_names:
+            raise KeyError(name)
+        self.commands.put(('poses', 'remove', (name,)))
+
+
+class RemoteZoneSet(object):
+    '''Stands in for the owner's `ZoneSet` in a worker, sending changes
+    to the owner to apply. Zones added by this worker are included in
+    `get_definitions` straight away, until the owner has published them.'''
+    def __init__(self, kinect_data, commands):
+        self.kinect_data = kinect_data
+        self.commands = commands
+        # Zones sent to the owner which may not be published yet, with the
+        # time they were sent.
+        self.pending = {}
+
+    def get_definitions(self):
+        definitions = dict(self.kinect_data.zone_definitions)
+        now = time.time()
+        for name, (zone, sent) in list(self.pending.items()):
+            if definitions.get(name) == zone or now - sent > OWNER_TIMEOUT:
+                del self.pending[name]
+            else:
+                definitions[name] = zone
+        return definitions
+
+    def add(self, name, zone):
+        self.pending[name] = (zone, time.time())
+        self.commands.put(('zones', 'add', (name, zone)))
+
+    def remove(self, name):
+        if name not in self.get_definitions():
+            raise KeyError(name)
+        self.pending.pop(name, None)
+        self.commands.put(('zones', 'remove', (name,)))
+
+
+class FrameCache(object):
+    '''Reuses responses until the next snapshot is published. Only
+    responses to GET requests for paths which depend on nothing but the
+    current snapshot are cached.
+
+    The cache is keyed on the snapshot's sequence number rather than the
+    frame number, since snapshots published without a new frame (after a
+    reconnect, a change to the poses or zones, or every PUBLISH_INTERVAL)
+    can change the answers too.'''
+    def __init__(self, kinect_data, operations_dashboard):
+        self.kinect_data = kinect_data
+        self.dashboard = operations_dashboard
+        self.sequence = None
+        self.responses = {}
+
+    def is_cacheable(self):
+        path = request.path
+        if (request.method != 'GET' or path.endswith(UNCACHEABLE_SUFFIXES) or
+                any(part in path for part in UNCACHEABLE_PARTS)):
+            return False
+        # Predictions depend on when the request arrives, not just the frame.
+        if 'predict' in request.args:
+            return False
+        return path == '/' or path.startswith(CACHEABLE_PREFIXES)
+
+    def install(self, app):
+        '''Adds the caching hooks to `app`.'''
+        @app.before_request
+        def use_cached_response():
+            if not self.is_cacheable():
+                return None
+            self.kinect_data.refresh()
+            sequence = self.kinect_data.sequence
+            if sequence != self.sequence:
+                self.sequence = sequence
+                self.responses = {}
+            cached = self.responses.get(request.full_path)
+            self.dashboard.record_cache(cached is not None)
+            if cached is None:
+                return None
+            body, status, headers = cached
+            return app.response_class(body, status, headers)
+
+        @app.after_request
+        def store_response(response):
+            if (response.status_code == 200 and not response.direct_passthrough and
+                    self.is_cacheable() and self.kinect_data.sequence == self.sequence):
+                if request.full_path not in self.responses:
+                    self.responses[request.full_path] = (
+                        response.get_data(), response.status_code, list(response.headers))
+            return response
+
+
+def run_worker(listener, shared, commands):
+    '''Serves requests on `listener` from the snapshots in `shared`. Used as
+    the target of each worker process.'''
+    import server
+
+    kinect_data = SharedKinectData(shared)
+    app = server.create_app(
+        kinect_data, RemotePoseLibrary(kinect_data, commands),
+        RemoteZoneSet(kinect_data, commands), cache_responses=True)
+
+    parent = os.getppid()
+
+    def exit_with_owner():
+        while True:
+            gevent.sleep(PARENT_CHECK_INTERVAL)
+            kinect_data.refresh()
+            if (os.getppid() != parent or
+                    kinect_data.seconds_since_snapshot() > OWNER_EXIT_TIMEOUT):
+                os._exit(0)
+
+    gevent.spawn(exit_with_owner)
+    try:
+        server.NoDelayWSGIServer(listener, app, log=None).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool(object):
+    '''Owns the Kinect, and runs `num_workers` worker processes serving its
+    data on `port`. The workers are started straight away; call
+    `kinect_data.start` to connect to the Kinect, then `serve_forever` to
+    apply the changes the workers send. Raises `RuntimeError` if this
+    version of Python can't share the listening socket between processes
+    (see `can_share_sockets`).'''
+    def __init__(self, num_workers, port, runtime_factory=None):
+        import server
+
+        if not can_share_sockets():
+            raise RuntimeError(
+                "Python 2 on Windows can't share the listening socket with worker processes")
+
+        self.kinect_data, self.pose_library, self.zone_set = (
+            server.create_kinect_data(runtime_factory))
+        self.targets = {'poses': self.pose_library, 'zones': self.zone_set}
+        self.shared = SharedFrame()
+        self.commands = multiprocessing.Queue()
+        self.running = True
+
+        with self.kinect_data.lock:
+            self._publish()
+        self.kinect_data.add_listener(self._publish_frame)
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+
+        # The workers are started before the Kinect, so they don't inherit
+        # its threads.
+        self.processes = []
+        for number in range(num_workers):
+            process = multiprocessing.Process(
+                target=run_worker, args=(self.listener, self.shared, self.commands),
+                name='Worker-{0}'.format(number + 1))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self.publisher = threading.Thread(target=self._publish_regularly, name='Publisher')
+        self.publisher.daemon = True
+        self.publisher.start()
+
+    def _publish(self):
+        self.shared.publish(take_snapshot(
+            self.kinect_data, self.pose_library, self.zone_set))
+
+    def _publish_regularly(self):
+        while self.running:
+            time.sleep(PUBLISH_INTERVAL)
+            with self.kinect_data.lock:
+                self._publish()
+
+    def _publish_frame(self, data):
+        self._publish()
+
+    def serve_forever(self):
+        '''Applies the changes sent by the workers until `stop` is called,
+        publishing a fresh snapshot after each one.'''
+        while self.running:
+            try:
+                target, method, args = self.commands.get(timeout=PUBLISH_INTERVAL)
+            except queue.Empty:
+                continue
+            try:
+                getattr(self.targets[target], method)(*args)
+            except (KeyError, ValueError):
+                # Another worker's change got there first.
+                pass
+            with self.kinect_data.lock:
+                self._publish()
+
+    def stop(self):
+        '''Stops the workers.'''
+        self.running = False
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.listener.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Tests every joint of every tracked player against a set of named 3D zones on
+each frame, and records when joints enter and leave them.
+
+Zones are boxes or spheres in the same coordinates the server reports: BYOB
+stage x and y, and z as the distance from the Kinect in millimeters. A zone
+can be limited to certain joints, such as the hands; otherwise every joint
+counts. All zones of a shape are tested against all joints at once with
+numpy, so hundreds of zones take about as long as a handful.
+"""
+
+from __future__ import print_function, division
+
+from collections import deque
+import threading
+import time
+
+import numpy
+
+import bones
+
+# Number of enter and leave events kept for clients to catch up on.
+EVENT_HISTORY = 100
+
+
+def make_box(x1, y1, z1, x2, y2, z2, joints=None):
+    '''Returns a box zone spanning the two given corners, which contains
+    only the given joints (or any joint, if `joints` is `None`). Raises
+    `ValueError` if a joint name is unknown.'''
+    corners = numpy.array([[x1, y1, z1], [x2, y2, z2]], dtype=float)
+    return {
+        'shape': 'box',
+        'min': corners.min(axis=0).tolist(),
+        'max': corners.max(axis=0).tolist(),
+        'joints': _check_joints(joints)
+    }
+
+
+def make_sphere(x, y, z, radius, joints=None):
+    '''Returns a sphere zone with the given center and radius, which
+    contains only the given joints (or any joint, if `joints` is `None`).
+    Raises `ValueError` if the radius is negative or a joint name is
+    unknown.'''
+    if radius < 0:
+        raise ValueError('The radius of a sphere cannot be negative')
+    return {
+        'shape': 'sphere',
+        'center': [float(x), float(y), float(z)],
+        'radius': float(radius),
+        'joints': _check_joints(joints)
+    }
+
+
+def _check_joints(joints):
+    if joints is None:
+        return None
+    joints = sorted(set(joints))
+    for joint in joints:
+        if joint not in bones.INDEX:
+            raise ValueError('Unknown joint ' + joint)
+    return joints
+
+
+def _compile(definitions):
+    '''Returns the zones in the form `ZoneSet.update` tests them in: the
+    zone names, a mask of which joints each zone contains, and arrays of the
+    box corners and sphere centers and radii.'''
+    names = sorted(definitions)
+    mask = numpy.ones((len(bones.JOINT_NAMES), len(names)), dtype=bool)
+    boxes, spheres = [], []
+    for column, name in enumerate(names):
+        zone = definitions[name]
+        if zone['joints'] is not None:
+            mask[:, column] = False
+            mask[[bones.INDEX[joint] for joint in zone['joints']], column] = True
+        if zone['shape'] == 'box':
+            boxes.append((column, zone['min'], zone['max']))
+        else:
+            spheres.append((column, zone['center'], zone['radius']))
+    return {
+        'names': names,
+        'mask': mask,
+        'box_columns': numpy.array([box[0] for box in boxes], dtype=int),
+        'box_min': numpy.array([box[1] for box in boxes]).reshape(-1, 3),
+        'box_max': numpy.array([box[2] for box in boxes]).reshape(-1, 3),
+        'sphere_columns': numpy.array([sphere[0] for sphere in spheres], dtype=int),
+        'sphere_centers': numpy.array([sphere[1] for sphere in spheres]).reshape(-1, 3),
+        'sphere_radii': numpy.array([sphere[2] for sphere in spheres])
+    }
+
+
+class ZoneSet(object):
+    '''Holds the zones. Pass the `update` method to
+    `KinectData.add_listener` to test the tracked players against them on
+    every frame.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = {}
+        # Replaced as a whole whenever the zones change, so the Kinect
+        # thread can read it without taking the lock.
+        self.compiled = _compile({})
+
+        self.inside = set()
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.next_event = 1
+
+    def get_definitions(self):
+        '''Returns a dictionary of every zone by name.'''
+        return dict(self.definitions)
+
+    def add(self, name, zone):
+        '''Adds a zone made by `make_box` or `make_sphere`, replacing any
+        zone with the same name.'''
+        with self.lock:
+            definitions = dict(self.definitions)
+            definitions[name] = zone
+            self.compiled = _compile(definitions)
+            self.definitions = definitions
+
+    def remove(self, name):
+        '''Deletes the zone with the given name. Raises `KeyError` if there
+        is no such zone.'''
+        with self.lock:
+            definitions = dict(self.definitions)
+            del definitions[name]
+            self.compiled = _compile(definitions)
+            self.definitions = definitions
+
+    def _test(self, compiled, positions):
+        '''Returns an array with a row per joint and a column per zone,
+        which is true where the joint is inside the zone.'''
+        inside = numpy.zeros((len(positions), len(compiled['names'])), dtype=bool)
+        if len(compiled['box_columns']):
+            inside[:, compiled['box_columns']] = numpy.logical_and(
+                positions[:, None, :] >= compiled['box_min'],
+                positions[:, None, :] <= compiled['box_max']).all(axis=2)
+        if len(compiled['sphere_columns']):
+            offsets = positions[:, None, :] - compiled['sphere_centers']
+            inside[:, compiled['sphere_columns']] = (
+                numpy.einsum('ijk,ijk->ij', offsets, offsets) <=
+                compiled['sphere_radii'] ** 2)
+        return inside
+
+    def update(self, data):
+        '''Stores the joints inside each zone in `data['zones']`, and the
+        most recent enter and leave events in `data['zone_events']`.'''
+        compiled = self.compiled
+        names = compiled['names']
+        players = sorted(data['tracked_players'])
+
+        inside = set()
+        if players and names:
+            positions = numpy.array([
+                [(joint['x'], joint['y'], joint['z'])
+                 for joint in (data['skeletons'][player][name] for name in bones.JOINT_NAMES)]
+                for player in players], dtype=float)
+            joint_count = len(bones.JOINT_NAMES)
+            hits = self._test(compiled, positions.reshape(-1, 3))
+            hits = hits.reshape(len(players), joint_count, len(names)) & compiled['mask']
+            for player, joint, zone in zip(*numpy.nonzero(hits)):
+                inside.add((names[zone], players[player], bones.JOINT_NAMES[joint]))
+
+        zones = dict((name, []) for name in names)
+        for name, player, joint in sorted(inside):
+            zones[name].append({'player': player, 'joint': joint})
+        data['zones'] = zones
+
+        # Joints in zones which have since been deleted leave silently.
+        previous = set(entry for entry in self.inside if entry[0] in zones)
+        changes = sorted(
+            [('leave',) + entry for entry in previous - inside] +
+            [('enter',) + entry for entry in inside - previous],
+            key=lambda change: change[1:])
+        self.inside = inside
+        if changes or 'zone_events' not in data:
+            now = time.time()
+            for kind, name, player, joint in changes:
+                self.events.append({
+                    'id': self.next_event, 'time': now, 'type': kind,
+                    'zone': name, 'player': player, 'joint': joint})
+                self.next_event += 1
+            data['zone_events'] = list(self.events)